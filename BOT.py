@@ -3,18 +3,28 @@
 # --- Miguel Guerrero / Adaptado por Gemini ---
 
 import streamlit as st
-import geopandas as gpd
-import pandas as pd
 import zipfile
-import tempfile
 import os
+import html
+import threading
+import time
 import folium
+import numpy as np
 import requests
-from io import BytesIO
 from streamlit_folium import st_folium
 
+import datos
+import exportar
+import indices
+import mapa
+import metricas
+
 st.set_page_config(page_title="Mapanima - Geovisor de Monitoreo Unificado", layout="wide")
 
+# Inicio e identificador de esta ejecución, para mostrar en el panel de rendimiento sólo sus mediciones
+inicio_ejecucion = time.time()
+id_ejecucion = metricas.iniciar_ejecucion()
+
 # --- Estilos generales e institucionales (Actualizados con la marca Bogotá) ---
 st.markdown("""
     <style>
@@ -119,128 +129,183 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# --- Función para descargar y cargar archivos ZIP de shapefiles ---
-@st.cache_data
-def descargar_y_cargar_zip(url):
+# --- Carga de las capas registradas en datos.py ---
+def mostrar_error_carga(capa, e):
+    """Informa en la interfaz por qué no se pudo cargar una capa."""
+    if isinstance(e, ValueError):
+        st.error(f"❌ Error: No se encontró ningún archivo .shp en el ZIP de {capa.descripcion}. Asegúrate de que el ZIP contenga un shapefile válido.")
+    elif isinstance(e, requests.exceptions.HTTPError):
+        st.error(f"❌ Error HTTP al descargar el archivo ZIP de {capa.descripcion}: {e}. Por favor, verifica la URL y tu conexión a internet.")
+    elif isinstance(e, requests.exceptions.ConnectionError):
+        st.error(f"❌ Error de conexión al descargar el archivo ZIP de {capa.descripcion}: {e}. Asegúrate de tener conexión a internet.")
+    elif isinstance(e, zipfile.BadZipFile):
+        st.error(f"❌ El archivo de {capa.descripcion} no es un ZIP válido. Asegúrate de que la URL apunte a un archivo ZIP.")
+    else:
+        st.error(f"❌ Error inesperado al cargar el archivo ZIP de {capa.descripcion}: {e}. Por favor, contacta al soporte.")
+
+@st.cache_resource
+def obtener_almacen_datos():
     """
-    Descarga un archivo ZIP desde una URL, lo extrae, y carga el shapefile contenido
-    en un GeoDataFrame, manejando diferentes codificaciones.
+    Carga en paralelo todas las capas del registro (caché en disco, ZIP incluido en el
+    repositorio o descarga) una sola vez por proceso. El almacén es de sólo lectura y lo
+    comparten todas las sesiones: no se copia en cada reejecución.
+    Un hilo en segundo plano revalida los ZIP publicados y, si cambian, publica la nueva
+    versión con sus índices ya calculados.
     """
-    try:
-        with st.spinner("Cargando datos geográficos principales... Esto puede tardar unos segundos."):
-            r = requests.get(url)
-            r.raise_for_status() # Lanza una excepción para errores HTTP (4xx o 5xx)
-            with zipfile.ZipFile(BytesIO(r.content)) as zip_ref:
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    zip_ref.extractall(tmpdir)
-                    shp_path = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir) if f.endswith(".shp")]
-                    if not shp_path:
-                        st.error("❌ Error: No se encontró ningún archivo .shp en el ZIP descargado. Asegúrate de que el ZIP contenga un shapefile válido.")
-                        return None
-                    
-                    gdf = None
-                    try:
-                        gdf = gpd.read_file(shp_path[0])
-                    except Exception as e:
-                        st.warning(f"⚠️ Advertencia: Error al cargar shapefile con encoding predeterminado. Intentando con 'latin1'. (Detalle: {e})")
-                        try:
-                            gdf = gpd.read_file(shp_path[0], encoding='latin1')
-                        except Exception as e_latin1:
-                            st.error(f"❌ Error crítico: No se pudo cargar el shapefile ni con encoding predeterminado ni con 'latin1'. (Detalle: {e_latin1})")
-                            return None
-                    
-                    # Asegurarse de que el GeoDataFrame final esté en CRS 4326 para Folium
-                    if gdf is not None and gdf.crs != "EPSG:4326":
-                        st.info("ℹ️ Reproyectando datos a EPSG:4326 para compatibilidad con el mapa.")
-                        gdf = gdf.to_crs(epsg=4326)
-                    
-                    # Rellenar valores NaN con una cadena vacía y luego convertir todas las columnas no geométricas a tipo string
-                    if gdf is not None:
-                        for col in gdf.columns:
-                            if col != gdf.geometry.name:
-                                gdf[col] = gdf[col].fillna('').astype(str) 
-
-                    return gdf
-
-    except requests.exceptions.HTTPError as e:
-        st.error(f"❌ Error HTTP al descargar el archivo ZIP: {e}. Por favor, verifica la URL y tu conexión a internet.")
-        return None
-    except requests.exceptions.ConnectionError as e:
-        st.error(f"❌ Error de conexión al descargar el archivo ZIP: {e}. Asegúrate de tener conexión a internet.")
-        return None
-    except zipfile.BadZipFile:
-        st.error("❌ El archivo descargado no es un ZIP válido. Asegúrate de que la URL apunte a un archivo ZIP.")
+    with st.spinner("Cargando datos geográficos... Esto puede tardar unos segundos."):
+        almacen = datos.AlmacenDatos(datos.cargar_capas())
+    # Único refresco del proceso: si el almacén se vuelve a crear, el del anterior se detiene
+    datos.iniciar_refresco(almacen, preparar=precalcular_derivados)
+    return almacen
+
+def precalcular_derivados(capas):
+    """
+    Calcula (y deja en caché) los índices de una nueva versión de las capas antes de publicarla,
+    para que la primera sesión que la vea no tenga que esperarlos. Las capas que no cambiaron
+    conservan su versión y reutilizan lo ya calculado.
+    """
+    gdf_poligonos, gdf_puntos = capas.get("poligonos"), capas.get("puntos")
+    if gdf_poligonos is not None:
+        version_poligonos = gdf_poligonos.attrs.get("version")
+        calcular_indice_filtros(gdf_poligonos, version_poligonos)
+        calcular_metricas_poligonos(gdf_poligonos, version_poligonos)
+        calcular_niveles_detalle(gdf_poligonos, version_poligonos)
+        calcular_indice_espacial(gdf_poligonos, version_poligonos)
+    if gdf_puntos is not None:
+        calcular_indice_espacial(gdf_puntos, gdf_puntos.attrs.get("version"))
+        calcular_rejilla_densidad(gdf_puntos, gdf_puntos.attrs.get("version"))
+    if gdf_poligonos is not None and gdf_puntos is not None:
+        asignacion = calcular_asignacion_ocupaciones(gdf_poligonos, gdf_puntos, version_poligonos, gdf_puntos.attrs.get("version"))
+        calcular_indice_temporal(gdf_puntos, asignacion, version_poligonos, gdf_puntos.attrs.get("version"))
+        calcular_indice_busqueda(gdf_poligonos, gdf_puntos, asignacion, version_poligonos, gdf_puntos.attrs.get("version"))
+
+# Los derivados se guardan por versión de los datos; se conservan sólo la actual y la anterior
+# (max_entries), para que una actualización no acumule índices de versiones que ya nadie usa
+@st.cache_resource(max_entries=2)
+def calcular_asignacion_ocupaciones(_gdf_poligonos, _gdf_puntos, version_poligonos, version_puntos):
+    """
+    Asigna cada ocupación al polígono que la contiene (STRtree) una sola vez por versión de
+    los datos; el resultado se comparte entre sesiones y reejecuciones.
+    """
+    return indices.AsignacionPuntos(_gdf_poligonos, _gdf_puntos)
+
+# Columna con la fecha de cada ocupación, para el análisis temporal
+COLUMNA_FECHA_OCUPACIONES = "Fecha_Ocu"
+
+@st.cache_resource(max_entries=2)
+def calcular_indice_temporal(_gdf_puntos, _asignacion, version_poligonos, version_puntos):
+    """
+    Índice temporal (conteos acumulados por mes y polígono) de las ocupaciones, una vez por
+    versión de los datos. Devuelve None si la capa no tiene fechas de ocupación utilizables.
+    """
+    if COLUMNA_FECHA_OCUPACIONES not in _gdf_puntos.columns:
         return None
-    except Exception as e:
-        st.error(f"❌ Error inesperado al cargar el archivo ZIP: {e}. Por favor, contacta al soporte.")
+    try:
+        return indices.IndiceTemporal(_gdf_puntos, _asignacion, COLUMNA_FECHA_OCUPACIONES)
+    except ValueError:
         return None
 
-@st.cache_data
-def descargar_y_cargar_zip_puntos(url):
+@st.cache_resource(max_entries=2)
+def calcular_rejilla_densidad(_gdf_puntos, version):
+    """Rejilla jerárquica de densidad de las ocupaciones, una vez por versión de los datos."""
+    return mapa.RejillaDensidad(_gdf_puntos.geometry.values)
+
+@st.cache_resource(max_entries=2)
+def calcular_metricas_poligonos(_gdf_poligonos, version):
+    """Área (CRS métrico) y variación 2023→2025 de cada polígono, una vez por versión de los datos."""
+    return indices.MetricasPoligonos(_gdf_poligonos)
+
+# Columnas en las que busca el cuadro de búsqueda (las que no existan en la capa se ignoran;
+# en OcuIle25 el identificador de la ocupación está en 'ocupacion_')
+COLUMNAS_BUSQUEDA = {
+    "poligonos": ["nombre_pol", "id_poligon"],
+    "puntos": ["id_ocupac", "id_predio", "ocupacion_"],
+}
+MAX_RESULTADOS_BUSQUEDA = 20
+# Zoom con el que se muestra una ocupación encontrada
+ZOOM_RESULTADO_BUSQUEDA = 18
+
+@st.cache_resource(max_entries=2)
+def calcular_indice_busqueda(_gdf_poligonos, _gdf_puntos, _asignacion, version_poligonos, version_puntos):
+    """Índice de prefijos y trigramas de nombres e identificadores, una vez por versión de los datos."""
+    return indices.IndiceBusqueda(
+        [("poligonos", _gdf_poligonos, COLUMNAS_BUSQUEDA["poligonos"]), ("puntos", _gdf_puntos, COLUMNAS_BUSQUEDA["puntos"])],
+        _asignacion
+    )
+
+@st.cache_resource(max_entries=2)
+def calcular_niveles_detalle(_gdf, version):
+    """Geometrías simplificadas por nivel de detalle, calculadas una vez por versión de los datos."""
+    return mapa.NivelesDetalle(_gdf.geometry.values)
+
+@st.cache_resource(max_entries=4)
+def calcular_indice_espacial(_gdf, version):
+    """Índice espacial (STRtree) de una capa, para consultas por vista del mapa y clics."""
+    return indices.IndiceEspacial(_gdf.geometry.values)
+
+# Límite de memoria de la caché de mapas y descargas generados (MB)
+MAX_MB_CACHE_VISTAS = int(os.environ.get("BOT_MAX_MB_CACHE_VISTAS", "256"))
+
+@st.cache_resource
+def obtener_cache_vistas():
+    """Caché LRU de mapas y descargas por combinación de filtros, compartida por todo el proceso."""
+    return mapa.CacheLRU(MAX_MB_CACHE_VISTAS * 1024 * 1024)
+
+@st.cache_resource
+def obtener_cola_exportaciones():
+    """Cola de trabajos de exportación compartida por todas las sesiones."""
+    return exportar.ColaExportaciones()
+
+def descarga_diferida(clave_vista, vista, nombre, generar):
     """
-    Descarga un archivo ZIP de puntos desde una URL, lo extrae, y carga el shapefile contenido
-    en un GeoDataFrame, manejando diferentes codificaciones y renombrando 'localidas' a 'Localidad'.
+    Devuelve una función para `st.download_button(data=...)` que genera la descarga `nombre`
+    sólo al hacer clic y la guarda junto al mapa en la caché de vistas, para no repetirla.
     """
+    def generar_midiendo():
+        with metricas.medir("exportacion", descarga=str(nombre)) as m:
+            contenido = generar()
+            m["bytes"] = len(contenido)
+        return contenido
+
+    def _obtener():
+        with vista["bloqueo"]:
+            contenido = vista["descargas"].get(nombre)
+        if contenido is None:
+            contenido = obtener_cola_exportaciones().resultado((clave_vista, nombre), generar_midiendo)
+            with vista["bloqueo"]:
+                vista["descargas"][nombre] = contenido
+                tamano = vista["bytes_mapa"] + sum(len(v) for v in vista["descargas"].values())
+            obtener_cache_vistas().guardar(clave_vista, vista, tamano)
+        return contenido
+    return _obtener
+
+@st.cache_resource(max_entries=2)
+def calcular_indice_filtros(_gdf_poligonos, version):
+    """Índice invertido de Localidad y nombre_pol, con las opciones de la barra lateral."""
+    return indices.IndiceFiltros(_gdf_poligonos, ["Localidad", "nombre_pol"])
+
+# --- Cargar datos principales (polígonos) y de puntos (ocupaciones) ---
+almacen_datos = obtener_almacen_datos()
+for nombre_capa, error_carga in almacen_datos.errores.items():
+    mostrar_error_carga(datos.CAPAS[nombre_capa], error_carga)
+gdf_poligonos, gdf_puntos = almacen_datos.capas("poligonos", "puntos")
+
+# --- Asignación precalculada de ocupaciones a polígonos ---
+asignacion_ocupaciones = None
+if gdf_poligonos is not None and gdf_puntos is not None:
     try:
-        with st.spinner("Cargando datos de puntos... Esto puede tardar unos segundos."):
-            r = requests.get(url)
-            r.raise_for_status()
-            with zipfile.ZipFile(BytesIO(r.content)) as zip_ref:
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    zip_ref.extractall(tmpdir)
-                    shp_path = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir) if f.endswith(".shp")]
-                    if not shp_path:
-                        st.error("❌ Error: No se encontró ningún archivo .shp en el ZIP de puntos. Asegúrate de que el ZIP contenga un shapefile válido.")
-                        return None
-                    
-                    gdf = None
-                    try:
-                        gdf = gpd.read_file(shp_path[0])
-                    except Exception as e:
-                        st.warning(f"⚠️ Advertencia: Error al cargar shapefile de puntos con encoding predeterminado. Intentando con 'latin1'. (Detalle: {e})")
-                        try:
-                            gdf = gpd.read_file(shp_path[0], encoding='latin1')
-                        except Exception as e_latin1:
-                            st.error(f"❌ Error crítico: No se pudo cargar el shapefile de puntos ni con encoding predeterminado ni con 'latin1'. (Detalle: {e_latin1})")
-                            return None
-                    
-                    if gdf is not None:
-                        # Renombrar 'localidas' a 'Localidad'
-                        if 'localidas' in gdf.columns:
-                            gdf.rename(columns={'localidas': 'Localidad'}, inplace=True)
-                            st.info("ℹ️ Columna 'localidas' renombrada a 'Localidad' en la capa de puntos.")
-                        
-                        # Asegurarse de que el GeoDataFrame final esté en CRS 4326 para Folium
-                        if gdf.crs != "EPSG:4326":
-                            st.info("ℹ️ Reproyectando datos de puntos a EPSG:4326 para compatibilidad con el mapa.")
-                            gdf = gdf.to_crs(epsg=4326)
-
-                        # Convertir columnas a string para consistencia, excepto geometría
-                        for col in gdf.columns:
-                            if col != gdf.geometry.name:
-                                gdf[col] = gdf[col].fillna('').astype(str)
-                    return gdf
-
-    except requests.exceptions.HTTPError as e:
-        st.error(f"❌ Error HTTP al descargar el archivo ZIP de puntos: {e}. Por favor, verifica la URL y tu conexión a internet.")
-        return None
-    except requests.exceptions.ConnectionError as e:
-        st.error(f"❌ Error de conexión al descargar el archivo ZIP de puntos: {e}. Asegúrate de tener conexión a internet.")
-        return None
-    except zipfile.BadZipFile:
-        st.error("❌ El archivo descargado no es un ZIP de puntos válido. Asegúrate de que la URL apunte a un archivo ZIP.")
-        return None
+        asignacion_ocupaciones = calcular_asignacion_ocupaciones(
+            gdf_poligonos, gdf_puntos, gdf_poligonos.attrs.get("version"), gdf_puntos.attrs.get("version")
+        )
     except Exception as e:
-        st.error(f"❌ Error inesperado al cargar el archivo ZIP de puntos: {e}. Por favor, contacta al soporte.")
-        return None
+        st.error(f"❌ Error durante el análisis espacial de ocupaciones: {e}")
 
-# --- Cargar datos principales (polígonos) ---
-url_zip_poligonos = "https://raw.githubusercontent.com/lmiguerrero/BOT/main/Pol_Monitoreo.zip"
-gdf_poligonos = descargar_y_cargar_zip(url_zip_poligonos)
-
-# --- Cargar datos de puntos ---
-url_zip_puntos = "https://raw.githubusercontent.com/lmiguerrero/BOT/main/OcuIle25.zip"
-gdf_puntos = descargar_y_cargar_zip_puntos(url_zip_puntos)
+# --- Índice temporal de las ocupaciones (sólo si la capa trae fechas) ---
+indice_temporal = None
+if asignacion_ocupaciones is not None:
+    indice_temporal = calcular_indice_temporal(
+        gdf_puntos, asignacion_ocupaciones, gdf_poligonos.attrs.get("version"), gdf_puntos.attrs.get("version")
+    )
 
 
 # --- Banner superior del visor ---
@@ -254,39 +319,83 @@ if gdf_poligonos is None:
 st.subheader("🗺️ Visor de Polígonos de Monitoreo y Ocupaciones")
 st.markdown("Filtros, mapa y descarga de información cartográfica según filtros aplicados.")
 
-# --- Nombres de columnas relevantes para polígonos ---
-COLUMNAS_ATRIBUTOS_POLIGONOS = [
-    'id_poligon', 'nombre_pol', 'Tipo_PMon', 'Localidad', 
-    'En_Proceso', 'Provisiona', 'Consolidac', 'Caracter_1', 'Abordaje_s',
-    'Total_2023', 'Lote_202', 'Lote_203', 'En_Proce_1', 'Provisio_1', 
-    'Consolid_1', 'Total_2025', 'Increment_1'
-]
+# Las columnas relevantes de polígonos (datos.COLUMNAS_ATRIBUTOS_POLIGONOS) se crean vacías
+# al cargar la capa si no vienen en el shapefile; aquí no se modifica la capa compartida.
 # Las columnas del shapefile de puntos se manejarán al activar la opción de ocupaciones.
 
-# Asegurar que las columnas existan y manejar sus tipos para polígonos
-for col_name in COLUMNAS_ATRIBUTOS_POLIGONOS:
-    if col_name in gdf_poligonos.columns:
-        gdf_poligonos[col_name] = gdf_poligonos[col_name].astype(str).str.lower().fillna('')
-    else:
-        gdf_poligonos[col_name] = '' 
+# Índice de filtros (clave normalizada → filas) y opciones ordenadas, una vez por versión de los datos
+indice_filtros = calcular_indice_filtros(gdf_poligonos, gdf_poligonos.attrs.get("version"))
 
 st.sidebar.header("🎯 Filtros")
 
+# --- Búsqueda indexada de polígonos y ocupaciones ---
+indice_busqueda = calcular_indice_busqueda(
+    gdf_poligonos, gdf_puntos, asignacion_ocupaciones,
+    gdf_poligonos.attrs.get("version"), gdf_puntos.attrs.get("version") if gdf_puntos is not None else None
+)
+nombre_pol_opciones = indice_filtros.opciones['nombre_pol']
+# Opción del filtro nombre_pol para cada clave normalizada (las opciones conservan una sola forma de cada nombre)
+opcion_nombre_pol = {datos.normalizar(o): o for o in nombre_pol_opciones}
+
+def etiqueta_resultado(resultado):
+    """Texto de un resultado de búsqueda en la lista: qué se encontró y en qué polígono está."""
+    if resultado["poligonos"]:
+        fila = gdf_poligonos.iloc[resultado["poligonos"][0]]
+        poligono = f"Polígono {fila['id_poligon']} · {fila['nombre_pol']}"
+    else:
+        poligono = "fuera de los polígonos de monitoreo"
+    if resultado["capa"] == "poligonos":
+        return poligono
+    return f"Ocupación {resultado['valor']} ({resultado['columna']}) → {poligono}"
+
+def ir_a_resultado(resultado, nombre_pol, centro):
+    """Filtra el visor al polígono del resultado y, si es una ocupación, la centra y la marca en el mapa."""
+    st.session_state["filtro_localidad"] = []
+    st.session_state["filtro_nombre_pol"] = nombre_pol
+    st.session_state["resultado_busqueda"] = {
+        "etiqueta": etiqueta_resultado(resultado), "nombre_pol": nombre_pol, "centro": centro,
+    }
+    st.session_state["mostrar_mapa"] = True
+
+texto_busqueda = st.sidebar.text_input(
+    "🔎 Buscar polígono u ocupación",
+    placeholder="Nombre o ID de polígono, ID de ocupación o predio",
+    help="No distingue mayúsculas ni tildes; encuentra coincidencias exactas, por prefijo o por parte del texto."
+)
+if texto_busqueda:
+    resultados_busqueda = indice_busqueda.buscar(texto_busqueda, limite=MAX_RESULTADOS_BUSQUEDA)
+    if resultados_busqueda:
+        resultado_sel = st.sidebar.selectbox("Resultados", resultados_busqueda, format_func=etiqueta_resultado)
+        nombre_pol_resultado = ""
+        if resultado_sel["poligonos"]:
+            nombre_pol_resultado = opcion_nombre_pol.get(
+                datos.normalizar(gdf_poligonos['nombre_pol'].iloc[resultado_sel["poligonos"][0]]), ""
+            )
+        centro_resultado = None
+        if resultado_sel["capa"] == "puntos":
+            punto = gdf_puntos.geometry.iloc[resultado_sel["posicion"]]
+            centro_resultado = [punto.y, punto.x]
+        st.sidebar.button("📍 Ir al resultado", on_click=ir_a_resultado,
+                          args=(resultado_sel, nombre_pol_resultado, centro_resultado))
+    else:
+        st.sidebar.caption("Sin coincidencias.")
+
 # Filtro por 'Localidad' (multiselect)
-localidad_opciones = sorted(gdf_poligonos['Localidad'].unique())
+localidad_opciones = indice_filtros.opciones['Localidad']
 localidad_sel = st.sidebar.multiselect(
     "Filtrar por Localidad", 
     options=localidad_opciones, 
-    placeholder="Selecciona una o más localidades"
+    placeholder="Selecciona una o más localidades",
+    key="filtro_localidad"
 )
 
 # Filtro por 'nombre_pol' (selectbox, una sola selección)
-nombre_pol_opciones = sorted(gdf_poligonos['nombre_pol'].unique())
 nombre_pol_seleccionado = st.sidebar.selectbox(
     "🔍 Buscar por nombre de Polígono (nombre_pol)", 
     options=[""] + nombre_pol_opciones, 
     index=0, 
-    placeholder="Selecciona un nombre"
+    placeholder="Selecciona un nombre",
+    key="filtro_nombre_pol"
 )
 
 # Sección de configuración del mapa
@@ -304,12 +413,52 @@ st.sidebar.header("🎨 Estilos del Mapa")
 mostrar_relleno_poligonos = st.sidebar.checkbox("Mostrar relleno de polígonos", value=True)
 
 # --- Nueva opción para ver ocupaciones ---
+MODOS_OCUPACIONES = ["Automático", "Puntos individuales", "Agrupadas (clúster)", "Densidad (rejilla)"]
 if gdf_puntos is not None:
     ver_ocupaciones = st.sidebar.checkbox("Ver ocupaciones", value=False)
+    modo_ocupaciones = st.sidebar.radio(
+        "Visualización de ocupaciones",
+        MODOS_OCUPACIONES,
+        index=0,
+        disabled=not ver_ocupaciones,
+        help=f"En modo automático, con más de {mapa.MAX_PUNTOS_INDIVIDUALES} ocupaciones se agrupan en clústeres. "
+             "Haz clic en una ocupación para ver sus atributos. La densidad muestra cuántas ocupaciones hay en "
+             "cada celda de una rejilla cuyo tamaño se ajusta al zoom."
+    )
 else:
     ver_ocupaciones = False
+    modo_ocupaciones = MODOS_OCUPACIONES[0]
     st.sidebar.info("Capa de ocupaciones no disponible para visualización.")
 
+# Rango de meses (posiciones en indice_temporal.periodos); None = todas las ocupaciones, con o sin fecha
+rango_meses = None
+if indice_temporal is not None:
+    etiquetas_meses = list(indice_temporal.periodos.astype(str))
+    mes_desde_sel, mes_hasta_sel = st.sidebar.select_slider(
+        "📅 Rango de fechas de ocupación",
+        options=etiquetas_meses,
+        value=(etiquetas_meses[0], etiquetas_meses[-1]),
+        disabled=not ver_ocupaciones,
+        help="Limita las ocupaciones del mapa, los conteos y la evolución mensual a las registradas en esos meses."
+    )
+    if (mes_desde_sel, mes_hasta_sel) != (etiquetas_meses[0], etiquetas_meses[-1]):
+        rango_meses = (etiquetas_meses.index(mes_desde_sel), etiquetas_meses.index(mes_hasta_sel))
+elif ver_ocupaciones:
+    st.sidebar.caption(f"La capa de ocupaciones no tiene fechas ({COLUMNA_FECHA_OCUPACIONES}): el análisis temporal no está disponible.")
+
+mostrar_solo_visible = st.sidebar.checkbox(
+    "Enviar sólo lo visible en el mapa",
+    value=False,
+    help="Al mover o acercar el mapa se envían únicamente los polígonos y ocupaciones de la vista, "
+         "con el nivel de detalle adecuado al zoom."
+)
+
+mostrar_panel_rendimiento = st.sidebar.checkbox(
+    "🛠️ Mostrar panel de rendimiento",
+    value=False,
+    help="Tiempos de cada etapa (carga, reproyección, asignación, mapa, exportaciones) con el número "
+         "de elementos y bytes procesados."
+)
 
 # Botones de acción
 if "mostrar_mapa" not in st.session_state:
@@ -322,51 +471,44 @@ with col_botones[0]:
 with col_botones[1]:
     if st.button("🔄 Reiniciar visor"):
         st.session_state["mostrar_mapa"] = False
+        st.session_state.pop("resultado_busqueda", None)
         st.rerun()
 
 # Lógica para mostrar el mapa y la tabla de resultados
 if st.session_state["mostrar_mapa"]:
-    gdf_filtrado_poligonos = gdf_poligonos.copy()
     gdf_puntos_filtrados = None
     total_ocupaciones_filtradas = 0
 
-    # Aplicar filtros a polígonos
-    if localidad_sel:
-        localidad_sel_lower = [loc.lower() for loc in localidad_sel]
-        gdf_filtrado_poligonos = gdf_filtrado_poligonos[gdf_filtrado_poligonos["Localidad"].isin(localidad_sel_lower)]
-    
-    if nombre_pol_seleccionado and nombre_pol_seleccionado != "":
-        gdf_filtrado_poligonos = gdf_filtrado_poligonos[gdf_filtrado_poligonos["nombre_pol"] == nombre_pol_seleccionado.lower()]
+    # Aplicar filtros a polígonos con el índice precalculado: posiciones de las filas que
+    # cumplen los filtros en gdf_poligonos (se usan también en los demás índices)
+    with metricas.medir("filtro_poligonos") as medicion:
+        posiciones_filtradas = indice_filtros.filtrar({
+            "Localidad": localidad_sel,
+            "nombre_pol": [nombre_pol_seleccionado] if nombre_pol_seleccionado else [],
+        })
+        gdf_filtrado_poligonos = gdf_poligonos.take(posiciones_filtradas)
+        medicion["features"] = len(gdf_filtrado_poligonos)
 
     st.subheader("🗺️ Mapa filtrado")
 
     if not gdf_filtrado_poligonos.empty:
-        # Preparar GeoDataFrame de puntos para el join y visualización si aplica
-        if ver_ocupaciones and gdf_puntos is not None:
-            st.info("Realizando análisis espacial de ocupaciones...")
-            # Asegúrate de que los CRS sean los mismos para el sjoin
-            if gdf_poligonos.crs != gdf_puntos.crs:
-                gdf_puntos_temp = gdf_puntos.to_crs(gdf_poligonos.crs)
-            else:
-                gdf_puntos_temp = gdf_puntos.copy()
-
-            # Realizar spatial join para obtener solo los puntos dentro de los polígonos filtrados
-            # y obtener los atributos del polígono para el conteo
+        # Ocupaciones dentro de los polígonos filtrados, a partir de la asignación precalculada
+        if ver_ocupaciones and gdf_puntos is not None and asignacion_ocupaciones is not None:
             try:
-                gdf_puntos_en_poligonos = gpd.sjoin(gdf_puntos_temp, gdf_filtrado_poligonos[['geometry', 'id_poligon']], how="inner", predicate="within")
-                
-                # Contar ocupaciones por polígono
-                conteo_ocupaciones = gdf_puntos_en_poligonos.groupby('id_poligon').size().reset_index(name='Cantidad_Ocupaciones')
-                total_ocupaciones_filtradas = conteo_ocupaciones['Cantidad_Ocupaciones'].sum()
-
-                # Unir el conteo a los polígonos filtrados para mostrar en la tabla y tooltip
-                gdf_filtrado_poligonos = pd.merge(
-                    gdf_filtrado_poligonos,
-                    conteo_ocupaciones,
-                    on='id_poligon',
-                    how='left'
-                ).fillna({'Cantidad_Ocupaciones': 0})
-                gdf_filtrado_poligonos['Cantidad_Ocupaciones'] = gdf_filtrado_poligonos['Cantidad_Ocupaciones'].astype(int)
+                with metricas.medir("seleccion_ocupaciones", rango_meses=rango_meses) as medicion:
+                    if rango_meses is not None:
+                        gdf_puntos_en_poligonos = indice_temporal.puntos_en(gdf_puntos, gdf_poligonos, posiciones_filtradas, *rango_meses)
+                        conteos_filtrados = indice_temporal.conteos(posiciones_filtradas, *rango_meses)
+                    else:
+                        gdf_puntos_en_poligonos = asignacion_ocupaciones.puntos_en(gdf_puntos, gdf_poligonos, posiciones_filtradas)
+                        conteos_filtrados = asignacion_ocupaciones.conteos[posiciones_filtradas]
+                    medicion["features"] = len(gdf_puntos_en_poligonos)
+
+                # Conteo de ocupaciones por polígono para la tabla y el tooltip
+                gdf_filtrado_poligonos = gdf_filtrado_poligonos.assign(
+                    Cantidad_Ocupaciones=conteos_filtrados.astype(int)
+                )
+                total_ocupaciones_filtradas = int(gdf_filtrado_poligonos['Cantidad_Ocupaciones'].sum())
 
                 gdf_puntos_filtrados = gdf_puntos_en_poligonos # Usar estos puntos para la visualización
 
@@ -374,13 +516,66 @@ if st.session_state["mostrar_mapa"]:
                 st.error(f"❌ Error durante el análisis espacial de ocupaciones: {e}")
                 gdf_puntos_filtrados = None # No mostrar puntos si hay error
 
+        # Área, variación 2023→2025 y ocupaciones por hectárea (áreas medidas en un CRS métrico una vez por versión)
+        metricas_poligonos = calcular_metricas_poligonos(gdf_poligonos, gdf_poligonos.attrs.get("version"))
+        gdf_filtrado_poligonos = gdf_filtrado_poligonos.assign(**metricas_poligonos.columnas(
+            posiciones_filtradas,
+            gdf_filtrado_poligonos['Cantidad_Ocupaciones'] if 'Cantidad_Ocupaciones' in gdf_filtrado_poligonos.columns else None
+        ))
+
         bounds = gdf_filtrado_poligonos.total_bounds
         centro_lat = (bounds[1] + bounds[3]) / 2
         centro_lon = (bounds[0] + bounds[2]) / 2
-        
-        with st.spinner("Generando mapa..."):
-            m = folium.Map(location=[centro_lat, centro_lon], zoom_start=8, tiles=fondos_disponibles[fondo_seleccionado])
 
+        tooltip_fields_poligonos = [
+            "id_poligon", "nombre_pol", "Tipo_PMon", "Localidad",
+            "En_Proceso", "Provisiona", "Consolidac", "Caracter_1", "Abordaje_s",
+            "Total_2023", "Lote_202", "Lote_203", "En_Proce_1", "Provisio_1", 
+            "Consolid_1", "Total_2025", "Increment_1", "Variacion_2023_2025", "Area_Ha"
+        ]
+        tooltip_aliases_poligonos = [
+            "ID Polígono:", "Nombre Polígono:", "Tipo Monitoreo:", "Localidad:",
+            "En Proceso:", "Provisional:", "Consolidado:", "Carácter:", "Abordaje:",
+            "Total 2023:", "Lote 202:", "Lote 203:", "En Proceso 1:", "Provisional 1:", 
+            "Consolidado 1:", "Total 2025:", "Incremento 1:", "Variación 2023→2025 (%):", "Área (ha):"
+        ]
+
+        if ver_ocupaciones and gdf_puntos is not None and 'Cantidad_Ocupaciones' in gdf_filtrado_poligonos.columns:
+            tooltip_fields_poligonos += ['Cantidad_Ocupaciones', 'Ocupaciones_Ha']
+            tooltip_aliases_poligonos += ['Ocupaciones en Polígono:', 'Ocupaciones por ha:']
+    
+        final_tooltip_fields_poligonos = []
+        final_tooltip_aliases_poligonos = []
+        for i, field in enumerate(tooltip_fields_poligonos):
+            if field in gdf_filtrado_poligonos.columns:
+                final_tooltip_fields_poligonos.append(field)
+                final_tooltip_aliases_poligonos.append(tooltip_aliases_poligonos[i])
+
+        tooltip_fields_puntos = ['id_ocupac', 'Clasific', 'id_predio', 'Localidad', 'Fecha_Ocu', 'Observacio']
+        tooltip_aliases_puntos = ['ID Ocupación:', 'Clasificación:', 'ID Predio:', 'Localidad:', 'Fecha Ocupación:', 'Observación:']
+
+        final_tooltip_fields_puntos = []
+        final_tooltip_aliases_puntos = []
+        if gdf_puntos_filtrados is not None:
+            for i, field in enumerate(tooltip_fields_puntos):
+                if field in gdf_puntos_filtrados.columns:
+                    final_tooltip_fields_puntos.append(field)
+                    final_tooltip_aliases_puntos.append(tooltip_aliases_puntos[i])
+
+        def datos_capa_poligonos(posiciones, tolerancia):
+            """
+            GeoJSON (texto) de los polígonos filtrados en `posiciones`, simplificados al nivel de detalle
+            de `tolerancia` y sólo con las columnas del tooltip, para reducir lo que se incrusta en el mapa.
+            """
+            filas = np.flatnonzero(np.isin(posiciones_filtradas, posiciones))
+            return mapa.gdf_para_mapa(
+                gdf_filtrado_poligonos.iloc[filas],
+                final_tooltip_fields_poligonos,
+                niveles_detalle_poligonos.geometrias(posiciones_filtradas[filas], tolerancia)
+            ).to_json()
+
+        def agregar_capa_poligonos(destino, geojson_poligonos):
+            """Capa de polígonos (GeoJSON de `datos_capa_poligonos`) con su tooltip."""
             def style_function_poligonos(feature):
                 return {
                     "fillColor": "#5B8EE6",
@@ -389,33 +584,8 @@ if st.session_state["mostrar_mapa"]:
                     "fillOpacity": 0.6 if mostrar_relleno_poligonos else 0
                 }
 
-            tooltip_fields_poligonos = [
-                "id_poligon", "nombre_pol", "Tipo_PMon", "Localidad",
-                "En_Proceso", "Provisiona", "Consolidac", "Caracter_1", "Abordaje_s",
-                "Total_2023", "Lote_202", "Lote_203", "En_Proce_1", "Provisio_1", 
-                "Consolid_1", "Total_2025", "Increment_1"
-            ]
-            tooltip_aliases_poligonos = [
-                "ID Polígono:", "Nombre Polígono:", "Tipo Monitoreo:", "Localidad:",
-                "En Proceso:", "Provisional:", "Consolidado:", "Carácter:", "Abordaje:",
-                "Total 2023:", "Lote 202:", "Lote 203:", "En Proceso 1:", "Provisional 1:", 
-                "Consolidado 1:", "Total 2025:", "Incremento 1:"
-            ]
-
-            if ver_ocupaciones and gdf_puntos is not None and 'Cantidad_Ocupaciones' in gdf_filtrado_poligonos.columns:
-                tooltip_fields_poligonos.append('Cantidad_Ocupaciones')
-                tooltip_aliases_poligonos.append('Ocupaciones en Polígono:')
-            
-            final_tooltip_fields_poligonos = []
-            final_tooltip_aliases_poligonos = []
-            for i, field in enumerate(tooltip_fields_poligonos):
-                if field in gdf_filtrado_poligonos.columns:
-                    final_tooltip_fields_poligonos.append(field)
-                    final_tooltip_aliases_poligonos.append(tooltip_aliases_poligonos[i])
-
-
             folium.GeoJson(
-                gdf_filtrado_poligonos,
+                geojson_poligonos,
                 name="Polígonos de Monitoreo",
                 style_function=style_function_poligonos,
                 tooltip=folium.GeoJsonTooltip(
@@ -423,22 +593,36 @@ if st.session_state["mostrar_mapa"]:
                     aliases=final_tooltip_aliases_poligonos,
                     localize=True
                 )
-            ).add_to(m)
-
-            # Añadir capa de puntos si 'Ver ocupaciones' está marcado y hay puntos filtrados
-            if ver_ocupaciones and gdf_puntos_filtrados is not None and not gdf_puntos_filtrados.empty:
-                tooltip_fields_puntos = ['id_ocupac', 'Clasific', 'id_predio', 'Localidad', 'Fecha_Ocu', 'Observacio']
-                tooltip_aliases_puntos = ['ID Ocupación:', 'Clasificación:', 'ID Predio:', 'Localidad:', 'Fecha Ocupación:', 'Observación:']
-                
-                final_tooltip_fields_puntos = []
-                final_tooltip_aliases_puntos = []
-                for i, field in enumerate(tooltip_fields_puntos):
-                    if field in gdf_puntos_filtrados.columns:
-                        final_tooltip_fields_puntos.append(field)
-                        final_tooltip_aliases_puntos.append(tooltip_aliases_puntos[i])
-
+            ).add_to(destino)
+
+        def datos_capa_ocupaciones(gdf_puntos_capa, tam_pixel):
+            """
+            (tipo, texto) de la capa de ocupaciones según el modo: 'densidad' con el GeoJSON de las celdas
+            (de al menos unos píxeles para el tamaño de píxel dado), 'cluster' con las coordenadas o
+            'puntos' con el GeoJSON de los puntos individuales y las columnas de su tooltip.
+            """
+            if modo_ocupaciones == "Densidad (rejilla)":
+                rejilla = calcular_rejilla_densidad(gdf_puntos, gdf_puntos.attrs.get("version"))
+                celdas = rejilla.celdas(gdf_puntos.index.get_indexer(gdf_puntos_capa.index), mapa.nivel_densidad(tam_pixel))
+                return "densidad", mapa.geojson_densidad(celdas)
+            agrupar_ocupaciones = (
+                modo_ocupaciones == "Agrupadas (clúster)"
+                or (modo_ocupaciones == "Automático" and len(gdf_puntos_capa) > mapa.MAX_PUNTOS_INDIVIDUALES)
+            )
+            if agrupar_ocupaciones:
+                # Sólo coordenadas; los atributos se consultan al hacer clic
+                return "cluster", mapa.coordenadas_agrupadas(gdf_puntos_capa)
+            return "puntos", mapa.gdf_para_mapa(gdf_puntos_capa, final_tooltip_fields_puntos).to_json()
+
+        def agregar_capa_ocupaciones(destino, tipo, texto):
+            """Capa de ocupaciones a partir de los datos de `datos_capa_ocupaciones`."""
+            if tipo == "densidad":
+                mapa.capa_densidad(texto, "Densidad de Ocupaciones").add_to(destino)
+            elif tipo == "cluster":
+                mapa.capa_puntos_agrupados(texto, "Ocupaciones Filtradas").add_to(destino)
+            else:
                 folium.GeoJson(
-                    gdf_puntos_filtrados,
+                    texto,
                     name="Ocupaciones Filtradas",
                     marker=folium.CircleMarker(radius=5, fill_color="#FF0000", color="#FF0000", fill_opacity=0.7),
                     tooltip=folium.GeoJsonTooltip(
@@ -446,24 +630,172 @@ if st.session_state["mostrar_mapa"]:
                         aliases=final_tooltip_aliases_puntos,
                         localize=True
                     )
-                ).add_to(m)
-            
-            folium.LayerControl().add_to(m) # Añadir control de capas
+                ).add_to(destino)
+
+        hay_puntos_en_mapa = ver_ocupaciones and gdf_puntos_filtrados is not None and not gdf_puntos_filtrados.empty
+        niveles_detalle_poligonos = calcular_niveles_detalle(gdf_poligonos, gdf_poligonos.attrs.get("version"))
+
+        # Capas ya serializadas para esta combinación de filtros y versión de los datos (caché LRU
+        # compartida, contabilizada por el tamaño real de los textos). En el modo "sólo lo visible"
+        # no se guardan capas: se arman en cada ejecución según la vista actual.
+        clave_vista = (
+            tuple(sorted(localidad_sel)), nombre_pol_seleccionado, fondo_seleccionado,
+            mostrar_relleno_poligonos, ver_ocupaciones, modo_ocupaciones, mostrar_solo_visible, rango_meses,
+            gdf_poligonos.attrs.get("version"), gdf_puntos.attrs.get("version") if gdf_puntos is not None else None
+        )
+        cache_vistas = obtener_cache_vistas()
+        vista = cache_vistas.obtener(clave_vista)
+
+        def calcular_capas_mapa():
+            """
+            Capas completas de los filtros actuales, ya serializadas (texto): polígonos al nivel de
+            detalle de su extensión y, si se muestran, las ocupaciones según el modo.
+            """
+            return {
+                "poligonos": datos_capa_poligonos(posiciones_filtradas, mapa.tolerancia_para_extension(bounds)),
+                "ocupaciones": datos_capa_ocupaciones(gdf_puntos_filtrados, mapa.tamano_pixel_extension(bounds)) if hay_puntos_en_mapa else None,
+            }
+
+        def crear_mapa(capas=None):
+            """
+            Mapa nuevo con el fondo, el encuadre y la leyenda; con `capas` (de `calcular_capas_mapa`)
+            incluye además esas capas. Cada ejecución arma el suyo: st_folium modifica el mapa que
+            renderiza, así que en la caché sólo se guardan los textos de las capas.
+            """
+            m = folium.Map(location=[centro_lat, centro_lon], zoom_start=8, tiles=fondos_disponibles[fondo_seleccionado])
+
+            if capas is not None:
+                agregar_capa_poligonos(m, capas["poligonos"])
+                # Añadir capa de puntos si 'Ver ocupaciones' está marcado y hay puntos filtrados
+                if capas["ocupaciones"] is not None:
+                    agregar_capa_ocupaciones(m, *capas["ocupaciones"])
+                folium.LayerControl().add_to(m) # Añadir control de capas
 
             m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
 
-            leyenda_html_poligonos = '''
+            # La leyenda de ocupaciones sólo aparece si se dibujan (el modo se conserva aunque 'Ver ocupaciones' esté desmarcado)
+            if not hay_puntos_en_mapa:
+                leyenda_ocupaciones = ""
+            elif modo_ocupaciones == "Densidad (rejilla)":
+                leyenda_ocupaciones = "".join(
+                    f'<i style="background:{color}; opacity:0.8; width:10px; height:10px; display:inline-block;"></i>'
+                    for color in mapa.COLORES_DENSIDAD
+                ) + " Densidad de ocupaciones (menor → mayor)<br>"
+            else:
+                leyenda_ocupaciones = '<i style="background:#FF0000; opacity:0.7; width:10px; height:10px; display:inline-block; border:1px solid #FF0000;"></i> Ocupación (Punto)<br>'
+
+            leyenda_html_poligonos = f'''
             <div style="position: absolute; bottom: 10px; right: 10px; z-index: 9999;
                         background-color: white; padding: 10px; border: 1px solid #ccc;
                         font-size: 14px; box-shadow: 2px 2px 4px rgba(0,0,0,0.1);">
                 <strong>Leyenda</strong><br>
                 <i style="background:#5B8EE6; opacity:0.7; width:10px; height:10px; display:inline-block; border:1px solid #1C3F93;"></i> Polígono de Monitoreo<br>
-                <i style="background:#FF0000; opacity:0.7; width:10px; height:10px; display:inline-block; border:1px solid #FF0000;"></i> Ocupación (Punto)<br>
+                {leyenda_ocupaciones}
             </div>
             '''
             m.get_root().html.add_child(folium.Element(leyenda_html_poligonos))
+            return m
+
+        if vista is None:
+            with st.spinner("Generando mapa..."), metricas.medir("construccion_mapa", poligonos=len(gdf_filtrado_poligonos)) as medicion_mapa:
+                capas_mapa = None if mostrar_solo_visible else calcular_capas_mapa()
+
+                # En el modo de densidad las ocupaciones no se envían: sólo unas pocas celdas
+                puntos_incrustados = hay_puntos_en_mapa and not mostrar_solo_visible and modo_ocupaciones != "Densidad (rejilla)"
+                bytes_mapa = 0
+                if capas_mapa is not None:
+                    bytes_mapa = len(capas_mapa["poligonos"]) + (len(capas_mapa["ocupaciones"][1]) if capas_mapa["ocupaciones"] else 0)
+                medicion_mapa["ocupaciones"] = len(gdf_puntos_filtrados) if puntos_incrustados else 0
+                medicion_mapa["bytes"] = bytes_mapa
+
+            vista = {
+                "capas": capas_mapa,
+                "bloqueo": threading.Lock(),
+                "bytes_mapa": bytes_mapa,
+                "descargas": {},
+            }
+            cache_vistas.guardar(clave_vista, vista, vista["bytes_mapa"])
+
+        # Ocupación encontrada con la búsqueda: se marca y se centra el mapa en ella, mientras el
+        # filtro siga siendo el que fijó la búsqueda (los polígonos ya quedan encuadrados por el filtro)
+        resultado_busqueda = st.session_state.get("resultado_busqueda")
+        capas_resultado, centro_mapa, zoom_mapa = [], None, None
+        if resultado_busqueda and resultado_busqueda["centro"] and resultado_busqueda["nombre_pol"] == nombre_pol_seleccionado:
+            grupo_resultado = folium.FeatureGroup(name="Resultado de búsqueda")
+            folium.Marker(
+                resultado_busqueda["centro"],
+                tooltip=html.escape(resultado_busqueda["etiqueta"]),
+                icon=folium.Icon(color="orange", icon="search")
+            ).add_to(grupo_resultado)
+            capas_resultado = [grupo_resultado]
+            centro_mapa, zoom_mapa = resultado_busqueda["centro"], ZOOM_RESULTADO_BUSQUEDA
+
+        if mostrar_solo_visible:
+            # Vista actual del mapa (la devuelve st_folium en la ejecución anterior); la primera vez
+            # se usa la extensión de los polígonos filtrados
+            estado_mapa = st.session_state.get("mapa_principal") or {}
+            caja_vista = mapa.caja_desde_limites(estado_mapa.get("bounds")) or tuple(bounds)
+            zoom_vista = estado_mapa.get("zoom")
+            tolerancia_vista = mapa.tolerancia_para_zoom(zoom_vista) if zoom_vista else mapa.tolerancia_para_extension(bounds)
+
+            # Polígonos filtrados que intersecan la vista, al nivel de detalle del zoom
+            posiciones_en_vista = calcular_indice_espacial(gdf_poligonos, gdf_poligonos.attrs.get("version")).en_caja(caja_vista)
+            en_vista = np.isin(posiciones_filtradas, posiciones_en_vista)
+            capas_vista = []
+            if en_vista.any():
+                capa_poligonos_vista = folium.FeatureGroup(name="Polígonos de Monitoreo")
+                agregar_capa_poligonos(capa_poligonos_vista, datos_capa_poligonos(posiciones_filtradas[en_vista], tolerancia_vista))
+                capas_vista.append(capa_poligonos_vista)
+
+            # Ocupaciones filtradas dentro de la vista
+            if hay_puntos_en_mapa:
+                posiciones_puntos_en_vista = calcular_indice_espacial(gdf_puntos, gdf_puntos.attrs.get("version")).en_caja(caja_vista)
+                puntos_en_vista = np.isin(gdf_puntos.index.get_indexer(gdf_puntos_filtrados.index), posiciones_puntos_en_vista)
+                if puntos_en_vista.any():
+                    capa_puntos_vista = folium.FeatureGroup(name="Ocupaciones Filtradas")
+                    agregar_capa_ocupaciones(capa_puntos_vista, *datos_capa_ocupaciones(
+                        gdf_puntos_filtrados.iloc[np.flatnonzero(puntos_en_vista)],
+                        mapa.tamano_pixel_zoom(zoom_vista) if zoom_vista else mapa.tamano_pixel_extension(bounds)
+                    ))
+                    capas_vista.append(capa_puntos_vista)
+
+            with metricas.medir("render_st_folium", modo="visible", capas=len(capas_vista)):
+                salida_mapa = st_folium(
+                    crear_mapa(), width=1200, height=600, key="mapa_principal",
+                    feature_group_to_add=capas_vista + capas_resultado, layer_control=folium.LayerControl(),
+                    center=centro_mapa, zoom=zoom_mapa,
+                    returned_objects=["last_object_clicked", "zoom", "bounds"]
+                )
+        else:
+            # Mapa nuevo armado con las capas cacheadas: cada sesión renderiza el suyo, sin esperar a otras
+            with metricas.medir("render_st_folium", modo="completo"):
+                salida_mapa = st_folium(
+                    crear_mapa(vista["capas"]), width=1200, height=600, feature_group_to_add=capas_resultado,
+                    center=centro_mapa, zoom=zoom_mapa, returned_objects=["last_object_clicked", "zoom"]
+                )
 
-            st_folium(m, width=1200, height=600)
+        # Atributos de la ocupación clicada (se consultan en el servidor, no van incrustados en el mapa)
+        if hay_puntos_en_mapa and modo_ocupaciones != "Densidad (rejilla)":
+            clic = (salida_mapa or {}).get("last_object_clicked")
+            if clic:
+                indice_puntos = calcular_indice_espacial(gdf_puntos, gdf_puntos.attrs.get("version"))
+                posicion_clic = indice_puntos.mas_cercano(
+                    clic["lng"], clic["lat"],
+                    mapa.tolerancia_clic(salida_mapa.get("zoom") or 8),
+                    permitidos=gdf_puntos.index.get_indexer(gdf_puntos_filtrados.index)
+                )
+                if posicion_clic is not None:
+                    atributos = gdf_puntos.iloc[posicion_clic].drop(gdf_puntos.geometry.name)
+                    filas_atributos = "".join(f"{html.escape(str(col))}: <strong>{html.escape(str(valor))}</strong><br>" for col, valor in atributos.items())
+                    st.markdown(
+                        f'''
+                        <div class="stats-box">
+                            <strong>📍 Ocupación seleccionada:</strong><br>
+                            {filas_atributos}
+                        </div>
+                        ''',
+                        unsafe_allow_html=True
+                    )
     else:
         st.warning("⚠️ No se encontraron polígonos que coincidan con los filtros aplicados. Por favor, ajusta tus selecciones.")
 
@@ -473,10 +805,10 @@ if st.session_state["mostrar_mapa"]:
             "id_poligon", "nombre_pol", "Tipo_PMon", "Localidad",
             "En_Proceso", "Provisiona", "Consolidac", "Total_2023", "Lote_202",
             "Lote_203", "En_Proce_1", "Provisio_1", "Consolid_1", "Total_2025",
-            "Increment_1", "Caracter_1", "Abordaje_s"
+            "Increment_1", "Caracter_1", "Abordaje_s", "Variacion_2023_2025", "Area_Ha"
         ]
         if 'Cantidad_Ocupaciones' in gdf_filtrado_poligonos.columns:
-            cols_to_display_poligonos.append('Cantidad_Ocupaciones')
+            cols_to_display_poligonos += ['Cantidad_Ocupaciones', 'Ocupaciones_Ha']
 
         cols_to_display_poligonos = [col for col in cols_to_display_poligonos if col in gdf_filtrado_poligonos.columns]
 
@@ -486,79 +818,101 @@ if st.session_state["mostrar_mapa"]:
 
         # Cuadro de estadísticas de ocupaciones
         if ver_ocupaciones and gdf_puntos is not None:
+            texto_rango = (
+                f"<br>Con fecha entre <strong>{mes_desde_sel}</strong> y <strong>{mes_hasta_sel}</strong>"
+                if rango_meses is not None else ""
+            )
             st.markdown(
                 f'''
                 <div class="stats-box">
                     <strong>📊 Estadísticas de Ocupaciones:</strong><br>
-                    Ocupaciones visibles en polígonos filtrados: <strong>{total_ocupaciones_filtradas}</strong>
+                    Ocupaciones visibles en polígonos filtrados: <strong>{total_ocupaciones_filtradas}</strong>{texto_rango}
                 </div>
                 ''',
                 unsafe_allow_html=True
             )
 
+            # Evolución mensual por Localidad de los polígonos filtrados (sumas de prefijos del índice temporal)
+            if indice_temporal is not None:
+                mes_desde, mes_hasta = rango_meses or (0, indice_temporal.num_meses - 1)
+                st.markdown("#### 📈 Ocupaciones por mes y Localidad")
+                st.bar_chart(indice_temporal.tabla_mensual(
+                    posiciones_filtradas, gdf_filtrado_poligonos['Localidad'].astype(str).to_numpy(), mes_desde, mes_hasta
+                ))
+
         with st.expander("📥 Opciones de descarga"):
-            # Para descargar el shapefile de polígonos filtrados
-            zip_buffer_poligonos = BytesIO()
-            with zipfile.ZipFile(zip_buffer_poligonos, 'w', zipfile.ZIP_DEFLATED) as zf:
-                with tempfile.TemporaryDirectory() as tmpdir_export_poligonos:
-                    shp_base_path_poligonos = os.path.join(tmpdir_export_poligonos, "poligonos_monitoreo_filtrados")
-                    gdf_filtrado_for_save_poligonos = gdf_filtrado_poligonos.copy()
-                    if gdf_filtrado_for_save_poligonos.crs is None:
-                        gdf_filtrado_for_save_poligonos.set_crs(epsg=4326, inplace=True)
-                    # Excluir 'Cantidad_Ocupaciones' si no quieres que sea parte del shapefile, o conviértela si es necesario.
-                    # Para simplificar, la guardamos tal cual, GeoPandas manejará el tipo de columna.
-                    gdf_filtrado_for_save_poligonos.to_file(shp_base_path_poligonos + ".shp")
-
-                    for file in os.listdir(tmpdir_export_poligonos):
-                        zf.write(os.path.join(tmpdir_export_poligonos, file), file)
-            zip_buffer_poligonos.seek(0)
+            # Las descargas no se generan al filtrar: cada botón recibe una función que las produce
+            # (en la cola de exportaciones) sólo cuando el usuario hace clic, y el resultado se guarda con el mapa
+            def generar_html_mapa(capas=vista["capas"], crear_mapa=crear_mapa, calcular_capas_mapa=calcular_capas_mapa):
+                # Con las capas filtradas completas (en el modo "sólo lo visible" no están en la caché)
+                return exportar.mapa_html(crear_mapa(capas if capas is not None else calcular_capas_mapa()))
+
+            formato_capas = st.selectbox("Formato de las capas", list(exportar.FORMATOS_CAPAS.keys()), index=0)
+            extension_capas, mime_capas, _ = exportar.FORMATOS_CAPAS[formato_capas]
+
+            descargas = {
+                "poligonos": descarga_diferida(
+                    clave_vista, vista, ("poligonos", formato_capas),
+                    lambda gdf=gdf_filtrado_poligonos, formato=formato_capas: exportar.exportar_capa(gdf, "poligonos_monitoreo_filtrados", formato)
+                ),
+                "html_mapa": descarga_diferida(clave_vista, vista, "html_mapa", generar_html_mapa),
+                "csv_resultados": descarga_diferida(
+                    clave_vista, vista, "csv_resultados",
+                    lambda df=gdf_filtrado_display_poligonos: exportar.tabla_csv(df)
+                ),
+            }
+            # Puntos filtrados si están visibles
+            if ver_ocupaciones and gdf_puntos_filtrados is not None and not gdf_puntos_filtrados.empty:
+                descargas["puntos"] = descarga_diferida(
+                    clave_vista, vista, ("puntos", formato_capas),
+                    lambda gdf=gdf_puntos_filtrados, formato=formato_capas: exportar.exportar_capa(gdf, "ocupaciones_filtradas", formato)
+                )
 
             st.download_button(
-                label="📅 Descargar shapefile de polígonos filtrado (.zip)",
-                data=zip_buffer_poligonos.getvalue(),
-                file_name="poligonos_monitoreo_filtrados.zip",
-                mime="application/zip"
+                label=f"📅 Descargar polígonos filtrados ({formato_capas})",
+                data=descargas["poligonos"],
+                file_name="poligonos_monitoreo_filtrados" + extension_capas,
+                mime=mime_capas
             )
 
             # Descargar mapa HTML
-            html_bytes_mapa = m.get_root().render().encode("utf-8")
             st.download_button(
                 label="🌐 Descargar mapa (HTML)",
-                data=html_bytes_mapa,
+                data=descargas["html_mapa"],
                 file_name="mapa_monitoreo_filtrado.html",
                 mime="text/html"
             )
 
             # Descargar tabla de resultados como CSV (ahora incluye Cantidad_Ocupaciones)
-            csv_resultados = gdf_filtrado_display_poligonos.to_csv(index=False).encode("utf-8")
             st.download_button(
                 label="📄 Descargar tabla de resultados como CSV",
-                data=csv_resultados,
+                data=descargas["csv_resultados"],
                 file_name="resultados_filtrados.csv",
                 mime="text/csv"
             )
 
             # Descargar puntos filtrados si están visibles
-            if ver_ocupaciones and gdf_puntos_filtrados is not None and not gdf_puntos_filtrados.empty:
-                zip_buffer_puntos = BytesIO()
-                with zipfile.ZipFile(zip_buffer_puntos, 'w', zipfile.ZIP_DEFLATED) as zf_puntos:
-                    with tempfile.TemporaryDirectory() as tmpdir_export_puntos:
-                        shp_base_path_puntos = os.path.join(tmpdir_export_puntos, "ocupaciones_filtradas")
-                        gdf_puntos_filtrados.to_file(shp_base_path_puntos + ".shp")
-
-                        for file in os.listdir(tmpdir_export_puntos):
-                            zf_puntos.write(os.path.join(tmpdir_export_puntos, file), file)
-                zip_buffer_puntos.seek(0)
-
+            if "puntos" in descargas:
                 st.download_button(
-                    label="📍 Descargar shapefile de ocupaciones filtrado (.zip)",
-                    data=zip_buffer_puntos.getvalue(),
-                    file_name="ocupaciones_filtradas.zip",
-                    mime="application/zip"
+                    label=f"📍 Descargar ocupaciones filtradas ({formato_capas})",
+                    data=descargas["puntos"],
+                    file_name="ocupaciones_filtradas" + extension_capas,
+                    mime=mime_capas
                 )
     else:
         st.info("No hay datos de polígonos para mostrar en la tabla o descargar con los filtros actuales.")
 
+# --- Panel de rendimiento (opcional) ---
+if mostrar_panel_rendimiento:
+    with st.sidebar.expander("⏱️ Rendimiento", expanded=True):
+        st.caption("Esta ejecución")
+        st.dataframe(
+            [{k: (round(v, 1) if k == "ms" else v) for k, v in medicion.items() if k not in ("marca_tiempo", "ejecucion")}
+             for medicion in metricas.registro.desde(inicio_ejecucion, ejecucion=id_ejecucion)]
+        )
+        st.caption("Acumulado del proceso (todas las sesiones)")
+        st.dataframe(metricas.registro.resumen())
+
 # --- Footer global para la pantalla principal del visor ---
 st.markdown(
     """
@@ -0,0 +1,340 @@
+# --- API LOCAL DE CONSULTAS (JSON / GeoJSON) ---
+# --- Sirve polígonos filtrados, ocupaciones, estadísticas por polígono y exportaciones a otras
+# --- herramientas, con las mismas capas (datos.py), índices (indices.py) y exportaciones (exportar.py) que el visor.
+# --- Uso: python api_consultas.py --puerto 8502 ---
+#
+# Endpoints (GET y HEAD):
+#   /salud                          estado y versión de las capas
+#   /poligonos                      GeoJSON de los polígonos filtrados, con conteos y métricas
+#   /ocupaciones                    GeoJSON de las ocupaciones dentro de los polígonos filtrados
+#   /estadisticas                   JSON (o CSV con formato=csv) con una fila por polígono filtrado
+#   /exportar/poligonos|ocupaciones archivo con formato=shp|parquet|gpkg|fgb
+#
+# Filtros comunes: localidad=...&localidad=... , nombre_pol=... , bbox=minx,miny,maxx,maxy (EPSG:4326).
+# Paginación: limite (máx. MAX_LIMITE) y desplazamiento; la respuesta trae total y el enlace siguiente.
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import datos
+import exportar
+import indices
+import mapa
+
+logger = logging.getLogger(__name__)
+
+LIMITE_POR_DEFECTO = 100
+MAX_LIMITE = 1000
+
+# Las respuestas menores que esto no se comprimen
+MIN_BYTES_GZIP = 1024
+
+# Límite de memoria de la caché de respuestas (MB)
+MAX_MB_CACHE_RESPUESTAS = int(os.environ.get("BOT_MAX_MB_CACHE_API", "128"))
+
+# Formatos de exportación por nombre corto -> etiqueta de exportar.FORMATOS_CAPAS
+FORMATOS_API = {
+    "shp": "Shapefile (.zip)",
+    "parquet": "GeoParquet (.parquet)",
+    "gpkg": "GeoPackage (.gpkg)",
+    "fgb": "FlatGeobuf (.fgb)",
+}
+
+COLUMNAS_ESTADISTICAS = ['id_poligon', 'nombre_pol', 'Tipo_PMon', 'Localidad', 'Total_2023', 'Total_2025']
+
+
+class ErrorConsulta(Exception):
+    """Parámetros inválidos o recurso inexistente; se responde con `estado` y un JSON {"error": ...}."""
+
+    def __init__(self, mensaje, estado=400):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+class ContextoConsultas:
+    """
+    Capas de una versión de los datos con todos los índices que usan las consultas, calculados
+    una sola vez. Cuando llega una versión nueva se construye otro contexto y se reemplaza entero.
+    """
+
+    def __init__(self, capas):
+        self.poligonos = capas.get("poligonos")
+        self.puntos = capas.get("puntos")
+        if self.poligonos is None:
+            raise ValueError("La capa de polígonos no está disponible.")
+        self.versiones = {n: g.attrs.get("version") for n, g in capas.items() if g is not None}
+
+        self.filtros = indices.IndiceFiltros(self.poligonos, ["Localidad", "nombre_pol"])
+        self.espacial_poligonos = indices.IndiceEspacial(self.poligonos.geometry.values)
+        self.metricas = indices.MetricasPoligonos(self.poligonos)
+        self.asignacion = self.espacial_puntos = None
+        if self.puntos is not None:
+            self.asignacion = indices.AsignacionPuntos(self.poligonos, self.puntos)
+            self.espacial_puntos = indices.IndiceEspacial(self.puntos.geometry.values)
+
+    def posiciones_poligonos(self, criterios, caja):
+        """Posiciones de los polígonos que cumplen los filtros y, si se indica, intersecan la caja."""
+        posiciones = self.filtros.filtrar(criterios)
+        if caja is not None:
+            posiciones = np.intersect1d(posiciones, self.espacial_poligonos.en_caja(caja), assume_unique=True)
+        return posiciones
+
+    def tabla_poligonos(self, posiciones):
+        """Atributos de los polígonos con Cantidad_Ocupaciones y las métricas (área, densidad, variación)."""
+        conteos = self.asignacion.conteos[posiciones] if self.asignacion is not None else np.zeros(len(posiciones), dtype=int)
+        tabla = self.poligonos.take(posiciones)
+        return tabla.assign(Cantidad_Ocupaciones=conteos, **self.metricas.columnas(posiciones, conteos))
+
+    def pares_ocupaciones(self, posiciones_poligonos, caja):
+        """(idx_puntos, idx_poligonos) de las ocupaciones en los polígonos indicados y dentro de la caja."""
+        if self.asignacion is None:
+            raise ErrorConsulta("La capa de ocupaciones no está disponible.", 503)
+        idx_puntos, idx_poligonos = self.asignacion.pares(posiciones_poligonos)
+        if caja is not None:
+            en_caja = np.isin(idx_puntos, self.espacial_puntos.en_caja(caja))
+            idx_puntos, idx_poligonos = idx_puntos[en_caja], idx_poligonos[en_caja]
+        return idx_puntos, idx_poligonos
+
+    def ocupaciones(self, idx_puntos, idx_poligonos):
+        """GeoDataFrame de las ocupaciones indicadas con el id_poligon que las contiene."""
+        resultado = self.puntos.iloc[idx_puntos].copy()
+        resultado['id_poligon'] = self.poligonos['id_poligon'].to_numpy()[idx_poligonos]
+        return resultado
+
+
+# --- Lectura de parámetros ---
+def _entero(parametros, nombre, por_defecto, minimo, maximo):
+    try:
+        valor = int(parametros.get(nombre, [por_defecto])[0])
+    except ValueError:
+        raise ErrorConsulta(f"'{nombre}' debe ser un número entero.")
+    if not minimo <= valor <= maximo:
+        raise ErrorConsulta(f"'{nombre}' debe estar entre {minimo} y {maximo}.")
+    return valor
+
+
+def _caja(parametros):
+    if "bbox" not in parametros:
+        return None
+    try:
+        caja = tuple(float(v) for v in parametros["bbox"][0].split(","))
+    except ValueError:
+        caja = ()
+    if len(caja) != 4 or caja[0] > caja[2] or caja[1] > caja[3]:
+        raise ErrorConsulta("'bbox' debe ser minx,miny,maxx,maxy en EPSG:4326.")
+    return caja
+
+
+def _criterios(parametros):
+    return {"Localidad": parametros.get("localidad", []), "nombre_pol": parametros.get("nombre_pol", [])}
+
+
+def _pagina(parametros):
+    return (_entero(parametros, "desplazamiento", 0, 0, sys.maxsize),
+            _entero(parametros, "limite", LIMITE_POR_DEFECTO, 1, MAX_LIMITE))
+
+
+def _geojson_pagina(gdf, ruta, parametros, total, desplazamiento, limite):
+    """FeatureCollection con las coordenadas redondeadas y los datos de paginación."""
+    gdf = gdf.set_geometry(mapa.redondear_coordenadas(gdf.geometry.values), crs=gdf.crs)
+    coleccion = gdf.to_geo_dict(na="null", drop_id=True)
+    siguiente = None
+    if desplazamiento + limite < total:
+        siguiente = f"{ruta}?{urlencode({**parametros, 'desplazamiento': [desplazamiento + limite]}, doseq=True)}"
+    coleccion.update({"total": total, "desplazamiento": desplazamiento, "limite": limite, "siguiente": siguiente})
+    return coleccion
+
+
+class ServicioConsultas:
+    """
+    Resuelve las consultas sobre el contexto vigente y guarda las respuestas ya generadas en
+    una caché LRU (por ruta, parámetros y versión de los datos), de modo que las consultas
+    repetidas no recalculan ni vuelven a serializar nada.
+    """
+
+    def __init__(self, almacen, max_mb_cache=MAX_MB_CACHE_RESPUESTAS):
+        self.almacen = almacen
+        self.contexto = ContextoConsultas(dict(zip(["poligonos", "puntos"], almacen.capas("poligonos", "puntos"))))
+        self.cache = mapa.CacheLRU(max_mb_cache * 1024 * 1024)
+        self.cola = exportar.ColaExportaciones()
+
+    def preparar(self, capas):
+        """Para `datos.RefrescoCapas`: construye los índices de la versión nueva y la publica de una vez."""
+        self.contexto = ContextoConsultas(capas)
+
+    def responder(self, ruta, parametros):
+        """
+        Devuelve (cuerpo, tipo MIME, encabezados adicionales, etag) para la consulta, desde la
+        caché si ya se generó para esta versión de los datos. Lanza ErrorConsulta si no es válida.
+        """
+        contexto = self.contexto
+        clave = (ruta, tuple(sorted((k, tuple(v)) for k, v in parametros.items())), tuple(sorted(contexto.versiones.items())))
+        respuesta = self.cache.obtener(clave)
+        if respuesta is None:
+            if ruta.startswith("/exportar/"):
+                if parametros.get("formato", ["gpkg"])[0] not in FORMATOS_API:
+                    raise ErrorConsulta(f"'formato' debe ser uno de: {', '.join(FORMATOS_API)}.")
+                # Exportaciones concurrentes iguales esperan el mismo trabajo
+                respuesta = self.cola.resultado(clave, lambda: self._generar(contexto, ruta, parametros))
+            else:
+                respuesta = self._generar(contexto, ruta, parametros)
+            cuerpo, tipo, encabezados = respuesta
+            etag = '"' + hashlib.sha256(repr(clave).encode("utf-8")).hexdigest()[:32] + '"'
+            respuesta = (cuerpo, tipo, encabezados, etag)
+            self.cache.guardar(clave, respuesta, len(cuerpo))
+        return respuesta
+
+    def _generar(self, contexto, ruta, parametros):
+        if ruta == "/salud":
+            return self._json({"estado": "ok", "versiones": contexto.versiones,
+                               "errores": {n: str(e) for n, e in self.almacen.errores.items()}})
+
+        caja = _caja(parametros)
+        posiciones = contexto.posiciones_poligonos(_criterios(parametros), caja)
+
+        if ruta == "/poligonos":
+            desplazamiento, limite = _pagina(parametros)
+            tabla = contexto.tabla_poligonos(posiciones[desplazamiento:desplazamiento + limite])
+            return self._json(_geojson_pagina(tabla, ruta, parametros, len(posiciones), desplazamiento, limite),
+                              "application/geo+json")
+
+        if ruta == "/ocupaciones":
+            desplazamiento, limite = _pagina(parametros)
+            idx_puntos, idx_poligonos = contexto.pares_ocupaciones(posiciones, caja)
+            pagina = slice(desplazamiento, desplazamiento + limite)
+            gdf = contexto.ocupaciones(idx_puntos[pagina], idx_poligonos[pagina])
+            return self._json(_geojson_pagina(gdf, ruta, parametros, len(idx_puntos), desplazamiento, limite),
+                              "application/geo+json")
+
+        if ruta == "/estadisticas":
+            tabla = contexto.tabla_poligonos(posiciones)
+            columnas = [c for c in COLUMNAS_ESTADISTICAS if c in tabla.columns]
+            columnas += ['Cantidad_Ocupaciones', 'Area_Ha', 'Ocupaciones_Ha', 'Variacion_2023_2025']
+            tabla = pd.DataFrame(tabla[columnas])
+            if parametros.get("formato", ["json"])[0] == "csv":
+                return exportar.tabla_csv(tabla), "text/csv; charset=utf-8", {}
+            desplazamiento, limite = _pagina(parametros)
+            filas = json.loads(tabla.iloc[desplazamiento:desplazamiento + limite].to_json(orient="records", force_ascii=False))
+            return self._json({
+                "total": len(tabla), "desplazamiento": desplazamiento, "limite": limite,
+                "total_ocupaciones": int(tabla['Cantidad_Ocupaciones'].sum()),
+                "poligonos": filas,
+            })
+
+        if ruta in ("/exportar/poligonos", "/exportar/ocupaciones"):
+            etiqueta = FORMATOS_API[parametros.get("formato", ["gpkg"])[0]]
+            if ruta == "/exportar/poligonos":
+                gdf, nombre_base = contexto.tabla_poligonos(posiciones), "poligonos_monitoreo_filtrados"
+            else:
+                gdf, nombre_base = contexto.ocupaciones(*contexto.pares_ocupaciones(posiciones, caja)), "ocupaciones_filtradas"
+            extension, mime, _ = exportar.FORMATOS_CAPAS[etiqueta]
+            return exportar.exportar_capa(gdf, nombre_base, etiqueta), mime, {
+                "Content-Disposition": f'attachment; filename="{nombre_base}{extension}"'
+            }
+
+        raise ErrorConsulta(f"Ruta desconocida: {ruta}", 404)
+
+    @staticmethod
+    def _json(objeto, tipo="application/json"):
+        return json.dumps(objeto, ensure_ascii=False, default=str).encode("utf-8"), f"{tipo}; charset=utf-8", {}
+
+
+class ManejadorConsultas(BaseHTTPRequestHandler):
+    """Atiende las peticiones GET con el ServicioConsultas del servidor (self.server.servicio)."""
+
+    server_version = "BOT-API/1.0"
+
+    def do_GET(self):
+        partes = urlsplit(self.path)
+        ruta = partes.path.rstrip("/") or "/"
+        parametros = parse_qs(partes.query)
+        try:
+            cuerpo, tipo, encabezados, etag = self.server.servicio.responder(ruta, parametros)
+        except ErrorConsulta as e:
+            self._enviar(e.estado, json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8"),
+                         "application/json; charset=utf-8")
+            return
+        except Exception as e:
+            logger.exception("Error al responder %s", self.path)
+            self._enviar(500, json.dumps({"error": f"Error interno: {e}"}, ensure_ascii=False).encode("utf-8"),
+                         "application/json; charset=utf-8")
+            return
+
+        if self.headers.get("If-None-Match") == etag:
+            self._enviar(304, b"", None, {"ETag": etag})
+            return
+        self._enviar(200, cuerpo, tipo, {"ETag": etag, **encabezados})
+
+    def _enviar(self, estado, cuerpo, tipo, encabezados=None):
+        encabezados = dict(encabezados or {})
+        if len(cuerpo) >= MIN_BYTES_GZIP and "gzip" in self.headers.get("Accept-Encoding", ""):
+            cuerpo = gzip.compress(cuerpo, compresslevel=5)
+            encabezados["Content-Encoding"] = "gzip"
+        self.send_response(estado)
+        if tipo:
+            self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.send_header("Vary", "Accept-Encoding")
+        for nombre, valor in encabezados.items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(cuerpo)
+
+    # HEAD responde los mismos encabezados que GET (Content-Length, ETag) sin el cuerpo
+    do_HEAD = do_GET
+
+    def log_message(self, formato, *args):
+        logger.info("%s %s", self.address_string(), formato % args)
+
+
+def crear_servidor(host, puerto, servicio):
+    """Servidor HTTP con un hilo por petición que responde con `servicio`."""
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorConsultas)
+    servidor.daemon_threads = True
+    servidor.servicio = servicio
+    return servidor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API local JSON/GeoJSON sobre las capas del visor.")
+    parser.add_argument("--host", default="127.0.0.1", help="Dirección en la que escuchar (por defecto, sólo local).")
+    parser.add_argument("--puerto", type=int, default=8502, help="Puerto HTTP.")
+    parser.add_argument("--intervalo-refresco", type=int, default=datos.INTERVALO_REFRESCO,
+                        help="Segundos entre revalidaciones de los ZIP publicados (0 la desactiva).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    almacen = datos.AlmacenDatos(datos.cargar_capas())
+    for nombre, e in almacen.errores.items():
+        logger.error("No se pudo cargar la capa de %s: %s", datos.CAPAS[nombre].descripcion, e)
+    if almacen.capa("poligonos") is None:
+        return 1
+
+    servicio = ServicioConsultas(almacen)
+    datos.iniciar_refresco(almacen, intervalo=args.intervalo_refresco, preparar=servicio.preparar)
+
+    servidor = crear_servidor(args.host, args.puerto, servicio)
+    logger.info("API escuchando en http://%s:%d", args.host, args.puerto)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
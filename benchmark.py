@@ -0,0 +1,277 @@
+# --- BENCHMARK DEL VISOR SOBRE LOS DATOS INCLUIDOS ---
+# --- Mide, sin red y sin caché en disco, cada etapa del visor con Pol_Monitoreo.zip y OcuIle25.zip,
+# --- y con copias sintéticas de las ocupaciones multiplicadas (10x, 100x) para dimensionar el crecimiento.
+# --- Uso: python benchmark.py --escalas 1 10 100 --json resultados.json [--comparar base.json] ---
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import folium
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import datos
+import estadisticas_ocupaciones
+import exportar
+import indices
+import mapa
+
+logger = logging.getLogger(__name__)
+
+# Desplazamiento máximo (en metros, CRS original de las capas) de las copias sintéticas de cada ocupación
+DISPERSION_COPIAS_M = 5.0
+
+
+def _pico_rss_mb():
+    """Pico de memoria residente del proceso hasta ahora (MB)."""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def medir_etapa(resultados, escala, etapa, funcion, repeticiones, memoria, **detalles):
+    """
+    Ejecuta `funcion()` `repeticiones` veces y guarda la mediana y el mínimo del tiempo.
+    Con `memoria`, una ejecución adicional bajo tracemalloc da el pico de memoria asignada
+    desde Python (incluye los arreglos de numpy, no la memoria interna de GEOS/GDAL).
+    Devuelve el resultado de la última ejecución.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        gc.collect()
+        inicio = time.perf_counter()
+        salida = funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+
+    pico_mb = None
+    if memoria:
+        gc.collect()
+        tracemalloc.start()
+        salida = funcion()
+        pico_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    if isinstance(salida, (bytes, str)):
+        detalles.setdefault("bytes", len(salida))
+    elif isinstance(salida, pd.DataFrame):
+        detalles.setdefault("filas", len(salida))
+
+    fila = {
+        "escala": escala,
+        "etapa": etapa,
+        "mediana_ms": round(statistics.median(tiempos), 1),
+        "min_ms": round(min(tiempos), 1),
+        "pico_mb": round(pico_mb, 1) if pico_mb is not None else None,
+        **detalles,
+    }
+    resultados.append(fila)
+    logger.info("%s", json.dumps(fila, ensure_ascii=False))
+    return salida
+
+
+def escalar_puntos(gdf_puntos, factor, semilla=0):
+    """
+    Copia sintética de la capa de ocupaciones con `factor` veces más filas: cada ocupación se
+    repite con un desplazamiento aleatorio (reproducible) de hasta DISPERSION_COPIAS_M metros,
+    de modo que casi todas las copias siguen dentro del mismo polígono.
+    """
+    if factor == 1:
+        return gdf_puntos
+    rng = np.random.default_rng(semilla)
+    copias = gdf_puntos.iloc[np.tile(np.arange(len(gdf_puntos)), factor)].reset_index(drop=True)
+    coords = shapely.get_coordinates(copias.geometry.values)
+    coords += rng.uniform(-DISPERSION_COPIAS_M, DISPERSION_COPIAS_M, coords.shape)
+    return copias.set_geometry(gpd.GeoSeries(shapely.points(coords), crs=gdf_puntos.crs))
+
+
+def construir_mapa(gdf_filtrado_poligonos, geometrias_poligonos, gdf_puntos_filtrados):
+    """Mapa de Folium armado como en el visor (polígonos simplificados con tooltip y ocupaciones)."""
+    bounds = gdf_filtrado_poligonos.total_bounds
+    m = folium.Map(location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2], zoom_start=8, tiles=None)
+    campos = [c for c in datos.COLUMNAS_ATRIBUTOS_POLIGONOS if c in gdf_filtrado_poligonos.columns]
+    folium.GeoJson(
+        mapa.gdf_para_mapa(gdf_filtrado_poligonos, campos, geometrias_poligonos),
+        name="Polígonos de Monitoreo",
+        tooltip=folium.GeoJsonTooltip(fields=campos, localize=True),
+    ).add_to(m)
+    if len(gdf_puntos_filtrados) > mapa.MAX_PUNTOS_INDIVIDUALES:
+        mapa.capa_puntos_agrupados(mapa.coordenadas_agrupadas(gdf_puntos_filtrados), "Ocupaciones Filtradas").add_to(m)
+    else:
+        campos_puntos = [c for c in ("Tipo_Ocu", "Localidad") if c in gdf_puntos_filtrados.columns]
+        folium.GeoJson(
+            mapa.gdf_para_mapa(gdf_puntos_filtrados, campos_puntos),
+            name="Ocupaciones Filtradas",
+            marker=folium.CircleMarker(radius=5, fill_color="#FF0000", color="#FF0000", fill_opacity=0.7),
+            tooltip=folium.GeoJsonTooltip(fields=campos_puntos, localize=True) if campos_puntos else None,
+        ).add_to(m)
+    m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+    return m
+
+
+def ejecutar(escalas, repeticiones=3, memoria=True, localidad=None, formatos=None):
+    """Mide todas las etapas para cada factor de `escalas` y devuelve una fila por (escala, etapa)."""
+    resultados = []
+    capa_poligonos, capa_puntos = datos.CAPAS["poligonos"], datos.CAPAS["puntos"]
+    with open(capa_poligonos.ruta_local, "rb") as f:
+        zip_poligonos = f.read()
+    with open(capa_puntos.ruta_local, "rb") as f:
+        zip_puntos = f.read()
+    formatos = formatos or list(exportar.FORMATOS_CAPAS)
+
+    # --- Etapas que no dependen de la escala de las ocupaciones ---
+    crudo_poligonos = medir_etapa(resultados, 1, "lectura_zip_poligonos", lambda: datos.leer_shapefile_zip(zip_poligonos),
+                                  repeticiones, memoria, bytes=len(zip_poligonos))
+    crudo_puntos = medir_etapa(resultados, 1, "lectura_zip_puntos", lambda: datos.leer_shapefile_zip(zip_puntos),
+                               repeticiones, memoria, bytes=len(zip_puntos))
+    gdf_poligonos = medir_etapa(resultados, 1, "normalizacion_poligonos",
+                                lambda: datos.preparar_capa(crudo_poligonos.copy(), capa_poligonos),
+                                repeticiones, memoria, features=len(crudo_poligonos))
+    niveles = medir_etapa(resultados, 1, "niveles_detalle", lambda: mapa.NivelesDetalle(gdf_poligonos.geometry.values),
+                          repeticiones, memoria, features=len(gdf_poligonos))
+    indice_filtros = medir_etapa(resultados, 1, "indice_filtros",
+                                 lambda: indices.IndiceFiltros(gdf_poligonos, ["Localidad", "nombre_pol"]),
+                                 repeticiones, memoria, features=len(gdf_poligonos))
+
+    # Por defecto se filtra la Localidad con más polígonos, como haría un usuario del visor
+    if localidad is None:
+        localidad = max(indice_filtros.opciones["Localidad"],
+                        key=lambda v: len(indice_filtros.filtrar({"Localidad": [v]})))
+    posiciones = medir_etapa(resultados, 1, "filtro", lambda: indice_filtros.filtrar({"Localidad": [localidad]}),
+                             repeticiones, memoria, localidad=localidad)
+    gdf_filtrado_poligonos = gdf_poligonos.take(posiciones)
+    geometrias_mapa = niveles.geometrias(posiciones, mapa.tolerancia_para_extension(gdf_filtrado_poligonos.total_bounds))
+
+    for formato in formatos:
+        medir_etapa(resultados, 1, f"exportar_poligonos[{formato}]",
+                    lambda formato=formato: exportar.exportar_capa(gdf_filtrado_poligonos, "poligonos", formato),
+                    repeticiones, memoria, features=len(gdf_filtrado_poligonos))
+
+    # --- Etapas que crecen con el número de ocupaciones ---
+    for escala in escalas:
+        crudo_escalado = escalar_puntos(crudo_puntos, escala)
+        gdf_puntos = medir_etapa(resultados, escala, "normalizacion_puntos",
+                                 lambda: datos.preparar_capa(crudo_escalado.copy(), capa_puntos),
+                                 repeticiones, memoria, features=len(crudo_escalado))
+        del crudo_escalado
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ruta = os.path.join(tmpdir, "puntos.parquet")
+            gdf_puntos.to_parquet(ruta)
+            medir_etapa(resultados, escala, "lectura_cache_puntos", lambda: gpd.read_parquet(ruta),
+                        repeticiones, memoria, bytes=os.path.getsize(ruta), features=len(gdf_puntos))
+
+        medir_etapa(resultados, escala, "sjoin_geopandas+groupby",
+                    lambda: gpd.sjoin(gdf_puntos, gdf_poligonos[["id_poligon", "geometry"]], how="inner", predicate="within")
+                    .groupby("id_poligon").size(),
+                    repeticiones, memoria, features=len(gdf_puntos))
+        asignacion = medir_etapa(resultados, escala, "asignacion_puntos",
+                                 lambda: indices.AsignacionPuntos(gdf_poligonos, gdf_puntos),
+                                 repeticiones, memoria, features=len(gdf_puntos))
+        medir_etapa(resultados, escala, "conteos_por_localidad",
+                    lambda: estadisticas_ocupaciones.conteos_por_localidad(
+                        estadisticas_ocupaciones.conteos_por_poligono(gdf_poligonos, gdf_puntos)),
+                    repeticiones, memoria, features=len(gdf_puntos))
+
+        gdf_puntos_filtrados = medir_etapa(resultados, escala, "seleccion_ocupaciones",
+                                           lambda: asignacion.puntos_en(gdf_puntos, gdf_poligonos, posiciones),
+                                           repeticiones, memoria)
+        m = medir_etapa(resultados, escala, "construccion_mapa",
+                        lambda: construir_mapa(gdf_filtrado_poligonos, geometrias_mapa, gdf_puntos_filtrados),
+                        repeticiones, memoria, features=len(gdf_puntos_filtrados))
+        medir_etapa(resultados, escala, "mapa_html", lambda: exportar.mapa_html(m), repeticiones, memoria)
+
+        tabla = gdf_filtrado_poligonos.drop(columns=gdf_filtrado_poligonos.geometry.name).assign(
+            Cantidad_Ocupaciones=asignacion.conteos[posiciones]
+        )
+        medir_etapa(resultados, escala, "exportar_csv", lambda: exportar.tabla_csv(tabla), repeticiones, memoria)
+        for formato in formatos:
+            medir_etapa(resultados, escala, f"exportar_puntos[{formato}]",
+                        lambda formato=formato: exportar.exportar_capa(gdf_puntos_filtrados, "ocupaciones", formato),
+                        repeticiones, memoria, features=len(gdf_puntos_filtrados))
+
+        resultados.append({"escala": escala, "etapa": "pico_rss_proceso", "pico_mb": round(_pico_rss_mb(), 1)})
+        del gdf_puntos, asignacion, gdf_puntos_filtrados, m
+        gc.collect()
+
+    return resultados
+
+
+def comparar(resultados, base, tolerancia):
+    """
+    Etapas cuya mediana supera en más de `tolerancia` (fracción) la de `base`
+    (la lista de resultados de una ejecución anterior). Devuelve [(escala, etapa, base_ms, actual_ms)].
+    """
+    referencia = {(r["escala"], r["etapa"]): r.get("mediana_ms") for r in base}
+    regresiones = []
+    for r in resultados:
+        anterior = referencia.get((r["escala"], r["etapa"]))
+        if anterior and r.get("mediana_ms") and r["mediana_ms"] > anterior * (1 + tolerancia):
+            regresiones.append((r["escala"], r["etapa"], anterior, r["mediana_ms"]))
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Mide cada etapa del visor con los ZIP incluidos y copias escaladas de las ocupaciones."
+    )
+    parser.add_argument("--escalas", type=int, nargs="+", default=[1, 10],
+                        help="Factores de multiplicación de las ocupaciones (por defecto 1 10; 100 tarda varios minutos).")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Ejecuciones cronometradas por etapa (se reporta la mediana).")
+    parser.add_argument("--sin-memoria", action="store_true", help="No medir el pico de memoria (evita la ejecución extra con tracemalloc).")
+    parser.add_argument("--localidad", help="Localidad del filtro (por defecto, la que tiene más polígonos).")
+    parser.add_argument("--formato", action="append", choices=list(exportar.FORMATOS_CAPAS), default=None,
+                        help="Formatos de exportación a medir (se puede repetir; por defecto, todos).")
+    parser.add_argument("--json", help="Guardar los resultados (y la descripción del entorno) en este archivo JSON.")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior con el que comparar las medianas.")
+    parser.add_argument("--tolerancia", type=float, default=0.25,
+                        help="Fracción de aumento de la mediana a partir de la cual una etapa se considera regresión.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    # Las mediciones internas de cada módulo (metricas.py) no aportan aquí y multiplican la salida
+    logging.getLogger("bot.metricas").setLevel(logging.WARNING)
+
+    resultados = ejecutar(args.escalas, args.repeticiones, not args.sin_memoria, args.localidad, args.formato)
+
+    tabla = pd.DataFrame(resultados)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(tabla.to_string(index=False))
+
+    if args.json:
+        entorno = {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "procesador": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+            "geopandas": gpd.__version__,
+            "shapely": shapely.__version__,
+            "pandas": pd.__version__,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"entorno": entorno, "resultados": resultados}, f, indent=2, ensure_ascii=False)
+        logger.info("Resultados guardados en %s", args.json)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            base = json.load(f)["resultados"]
+        regresiones = comparar(resultados, base, args.tolerancia)
+        for escala, etapa, anterior, actual in regresiones:
+            logger.warning("Regresión en %s (escala %sx): %.1f ms -> %.1f ms", etapa, escala, anterior, actual)
+        if regresiones:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,641 @@
+# --- CARGA DE CAPAS GEOGRÁFICAS CON CACHÉ PERSISTENTE ---
+# --- Lee los ZIP de shapefiles (incluidos en el repositorio o descargados) y guarda
+# --- el resultado ya procesado en GeoParquet para que los arranques siguientes sean inmediatos ---
+
+import codecs
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+
+import geopandas as gpd
+import pandas as pd
+import requests
+
+import metricas
+
+logger = logging.getLogger(__name__)
+
+RUTA_BASE = os.path.dirname(os.path.abspath(__file__))
+
+# Directorio de la caché en disco (se puede cambiar con la variable de entorno BOT_DIR_CACHE)
+DIRECTORIO_CACHE = os.environ.get("BOT_DIR_CACHE", os.path.join(RUTA_BASE, ".cache_capas"))
+
+# Formato de la caché en disco: "parquet" (GeoParquet comprimido, por defecto) o "feather"
+# (Arrow IPC sin comprimir, leído con memory map: las columnas numéricas quedan respaldadas
+# por el archivo mapeado y varios procesos del servidor comparten esas páginas)
+FORMATO_CACHE = os.environ.get("BOT_FORMATO_CACHE", "parquet")
+
+# Incrementar cuando cambie el procesamiento de las capas, para invalidar la caché existente
+VERSION_PROCESAMIENTO = 3
+
+# Copy-on-Write (por defecto desde pandas 3): las vistas que se entregan del almacén de datos
+# no se copian hasta que alguien intenta modificarlas, y nunca modifican el original
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+ARCHIVO_MANIFIESTO = "manifiesto.json"
+
+# Origen de los ZIP publicados; se puede apuntar a un servidor local (p. ej. `python -m http.server`)
+URL_BASE_CAPAS = os.environ.get("BOT_URL_BASE_CAPAS", "https://raw.githubusercontent.com/lmiguerrero/BOT/main")
+
+# Segundos entre revalidaciones de los ZIP publicados (0 desactiva la actualización en segundo plano)
+INTERVALO_REFRESCO = int(os.environ.get("BOT_INTERVALO_REFRESCO", "900"))
+
+# Tiempo máximo de espera de una descarga (segundos)
+TIEMPO_ESPERA_DESCARGA = 60
+
+
+def hash_contenido(contenido):
+    """Devuelve el hash SHA-256 (hexadecimal) de los bytes de un ZIP."""
+    return hashlib.sha256(contenido).hexdigest()
+
+
+# --- Lectura y procesamiento del shapefile ---
+def _encoding_desde_cpg(texto_cpg):
+    """
+    Traduce el contenido de un archivo .cpg ('UTF-8', '1252', 'ANSI 1252', '88591', ...)
+    a un nombre de codificación de Python. Devuelve None si no se reconoce.
+    """
+    valor = texto_cpg.strip().upper().replace("ANSI", "").strip()
+    equivalencias = {"88591": "latin1", "8859_1": "latin1", "ISO88591": "latin1"}
+    if valor in equivalencias:
+        return equivalencias[valor]
+    if valor.isdigit():
+        valor = f"cp{valor}"
+    try:
+        return codecs.lookup(valor).name
+    except LookupError:
+        return None
+
+
+def leer_shapefile_zip(contenido):
+    """
+    Lee el shapefile directamente desde el ZIP en memoria, sin extraerlo a disco.
+    GDAL (/vsizip/) sólo descomprime los miembros que necesita (.shp, .shx, .dbf, .prj, .cpg);
+    los índices .sbn/.sbx y los metadatos .shp.xml se ignoran.
+    La codificación se toma del .cpg cuando existe, para leer el archivo una sola vez.
+    """
+    with zipfile.ZipFile(BytesIO(contenido)) as zip_ref:
+        miembros = zip_ref.namelist()
+        shp_path = [m for m in miembros if m.lower().endswith(".shp")]
+        if not shp_path:
+            raise ValueError("No se encontró ningún archivo .shp en el ZIP.")
+        base = shp_path[0][:-len(".shp")]
+        cpg = [m for m in miembros if m.lower() == (base + ".cpg").lower()]
+        encoding = _encoding_desde_cpg(zip_ref.read(cpg[0]).decode("ascii", "ignore")) if cpg else None
+
+    with metricas.medir("lectura_shapefile", capa=os.path.basename(base), bytes=len(contenido)) as m:
+        gdf = gpd.read_file(BytesIO(contenido), layer=os.path.basename(base), encoding=encoding)
+        m["features"] = len(gdf)
+    return gdf
+
+
+# --- Esquema de columnas ---
+# Columnas de texto que siempre se guardan como categóricas (pocos valores distintos)
+COLUMNAS_CATEGORICAS = ['Localidad', 'Tipo_PMon', 'Clasific']
+
+# Además, una columna de texto pasa a categórica si sus valores distintos son como máximo
+# esta fracción del total de filas
+FRACCION_MAX_CATEGORICA = 0.1
+
+
+def normalizar(texto):
+    """
+    Clave normalizada para comparar textos sin distinguir mayúsculas ni tildes
+    ('Usaquén', 'USAQUEN ' y 'usaquen' dan la misma clave).
+    """
+    texto = unicodedata.normalize("NFKD", str(texto).strip().casefold())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def mascara_normalizada(serie, valores):
+    """
+    Máscara booleana de las filas de `serie` cuyo valor coincide (por clave normalizada)
+    con alguno de `valores`. En columnas categóricas sólo se normalizan las categorías.
+    """
+    claves = {normalizar(v) for v in valores}
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie.isin([c for c in serie.cat.categories if normalizar(c) in claves])
+    return serie.map(normalizar).isin(claves)
+
+
+def opciones_unicas(serie):
+    """
+    Valores distintos de `serie` para mostrar en un filtro: uno por clave normalizada
+    (se conserva la primera forma encontrada), ordenados por esa clave.
+    """
+    valores = serie.cat.categories if isinstance(serie.dtype, pd.CategoricalDtype) else serie.unique()
+    por_clave = {}
+    for valor in valores:
+        por_clave.setdefault(normalizar(valor), str(valor))
+    return [por_clave[clave] for clave in sorted(por_clave)]
+
+
+def aplicar_esquema(gdf, categoricas=()):
+    """
+    Tipa las columnas no geométricas: las numéricas y de fecha conservan su tipo, las de texto se
+    rellenan con '' y las de baja cardinalidad (o listadas en COLUMNAS_CATEGORICAS o
+    `categoricas`) se convierten a categóricas.
+    """
+    for col in gdf.columns:
+        if (col == gdf.geometry.name or pd.api.types.is_numeric_dtype(gdf[col])
+                or pd.api.types.is_datetime64_any_dtype(gdf[col])):
+            continue
+        serie = gdf[col].fillna('').astype(str)
+        if col in COLUMNAS_CATEGORICAS or col in categoricas or serie.nunique() <= FRACCION_MAX_CATEGORICA * len(serie):
+            serie = serie.astype('category')
+        gdf[col] = serie
+    return gdf
+
+
+def preparar_capa(gdf, capa):
+    """
+    Renombra columnas (sin distinguir mayúsculas), reproyecta al CRS de la capa
+    (EPSG:4326 para Folium) y aplica el esquema de tipos.
+    """
+    if capa.renombrar:
+        renombrar = {normalizar(k): v for k, v in capa.renombrar.items()}
+        gdf = gdf.rename(columns={c: renombrar[normalizar(c)] for c in gdf.columns if normalizar(c) in renombrar})
+
+    if gdf.crs != capa.crs:
+        with metricas.medir("reproyeccion", capa=capa.nombre, features=len(gdf)):
+            gdf = gdf.to_crs(capa.crs)
+
+    # Columnas que el visor espera aunque no vengan en el shapefile
+    for col in capa.columnas:
+        if col not in gdf.columns:
+            gdf[col] = ''
+
+    with metricas.medir("esquema", capa=capa.nombre, features=len(gdf)):
+        return aplicar_esquema(gdf, capa.categoricas)
+
+
+# --- Registro de capas ---
+@dataclass(frozen=True)
+class Capa:
+    """
+    Definición declarativa de una capa: de dónde se carga (URL y/o ZIP local), cómo se
+    renombran sus columnas, a qué CRS se lleva, qué columnas deben existir y cuáles se
+    guardan como categóricas.
+    """
+    nombre: str
+    descripcion: str
+    url: str = None
+    ruta_local: str = None
+    renombrar: dict = field(default_factory=dict)
+    crs: str = "EPSG:4326"
+    columnas: tuple = ()
+    categoricas: tuple = ()
+
+    def huella(self):
+        """Hash corto de la definición: si cambia, la caché de la capa se reconstruye."""
+        definicion = json.dumps([
+            VERSION_PROCESAMIENTO, sorted(self.renombrar.items()), self.crs,
+            list(self.columnas), sorted(self.categoricas)
+        ])
+        return hashlib.sha256(definicion.encode("utf-8")).hexdigest()[:8]
+
+
+# Capas disponibles, por nombre; se cargan todas juntas con `cargar_capas`
+CAPAS = {}
+
+
+def registrar_capa(capa):
+    """Añade (o reemplaza) una capa en el registro."""
+    CAPAS[capa.nombre] = capa
+    return capa
+
+
+# Atributos de los polígonos que usa el visor (tooltip, tabla y descargas)
+COLUMNAS_ATRIBUTOS_POLIGONOS = (
+    'id_poligon', 'nombre_pol', 'Tipo_PMon', 'Localidad',
+    'En_Proceso', 'Provisiona', 'Consolidac', 'Caracter_1', 'Abordaje_s',
+    'Total_2023', 'Lote_202', 'Lote_203', 'En_Proce_1', 'Provisio_1',
+    'Consolid_1', 'Total_2025', 'Increment_1'
+)
+
+registrar_capa(Capa(
+    nombre="poligonos",
+    descripcion="polígonos de monitoreo",
+    url=f"{URL_BASE_CAPAS}/Pol_Monitoreo.zip",
+    ruta_local=os.path.join(RUTA_BASE, "Pol_Monitoreo.zip"),
+    columnas=COLUMNAS_ATRIBUTOS_POLIGONOS,
+))
+registrar_capa(Capa(
+    nombre="puntos",
+    descripcion="puntos de ocupaciones",
+    url=f"{URL_BASE_CAPAS}/OcuIle25.zip",
+    ruta_local=os.path.join(RUTA_BASE, "OcuIle25.zip"),
+    renombrar={'localidas': 'Localidad'},
+))
+
+
+# --- Caché en disco ---
+def _ruta_cache(capa, clave):
+    extension = "arrow" if FORMATO_CACHE == "feather" else "parquet"
+    return os.path.join(DIRECTORIO_CACHE, f"{capa.nombre}-{capa.huella()}-{clave[:16]}.{extension}")
+
+
+def _leer_cache(capa, clave):
+    ruta = _ruta_cache(capa, clave)
+    if not os.path.exists(ruta):
+        return None
+    try:
+        with metricas.medir("lectura_cache", capa=capa.nombre, formato=FORMATO_CACHE, bytes=os.path.getsize(ruta)) as m:
+            if FORMATO_CACHE == "feather":
+                gdf = gpd.read_feather(ruta, memory_map=True)
+            else:
+                gdf = gpd.read_parquet(ruta)
+            m["features"] = len(gdf)
+        return gdf
+    except Exception as e:  # pyarrow no instalado o archivo corrupto: se reconstruye
+        logger.warning("No se pudo leer la caché %s: %s", ruta, e)
+        return None
+
+
+def _escribir_cache(capa, clave, gdf):
+    """Escribe el GeoParquet de forma atómica (archivo temporal + os.replace)."""
+    ruta = _ruta_cache(capa, clave)
+    try:
+        os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+        fd, ruta_tmp = tempfile.mkstemp(dir=DIRECTORIO_CACHE, suffix=".tmp")
+        os.close(fd)
+        try:
+            with metricas.medir("escritura_cache", capa=capa.nombre, formato=FORMATO_CACHE, features=len(gdf)) as m:
+                if FORMATO_CACHE == "feather":
+                    gdf.to_feather(ruta_tmp, compression="uncompressed")
+                else:
+                    gdf.to_parquet(ruta_tmp)
+                m["bytes"] = os.path.getsize(ruta_tmp)
+            os.replace(ruta_tmp, ruta)
+        finally:
+            if os.path.exists(ruta_tmp):
+                os.remove(ruta_tmp)
+    except Exception as e:  # la caché es opcional: la app sigue funcionando sin ella
+        logger.warning("No se pudo escribir la caché %s: %s", ruta, e)
+        return
+    _limpiar_cache(capa, conservar=[clave])
+
+
+def _limpiar_cache(capa, conservar=()):
+    """
+    Borra los archivos de caché de `capa` que ya no se usan: los de otra huella (otra definición
+    o VERSION_PROCESAMIENTO) y los de versiones anteriores de los datos. Se conservan las claves
+    de `conservar`, la del ZIP local y la de la descarga que registra el manifiesto.
+    """
+    claves = {clave[:16] for clave in conservar}
+    if capa.url:
+        registro = _leer_manifiesto().get(capa.url)
+        if registro:
+            claves.add(registro["clave"][:16])
+    if capa.ruta_local and os.path.exists(capa.ruta_local):
+        with open(capa.ruta_local, "rb") as f:
+            claves.add(hash_contenido(f.read())[:16])
+
+    patron = re.compile(rf"{re.escape(capa.nombre)}-([0-9a-f]{{8}})-([0-9a-f]{{16}})\.(parquet|arrow)")
+    huella = capa.huella()
+    try:
+        archivos = os.listdir(DIRECTORIO_CACHE)
+    except OSError:
+        return
+    for archivo in archivos:
+        coincidencia = patron.fullmatch(archivo)
+        if coincidencia and (coincidencia.group(1) != huella or coincidencia.group(2) not in claves):
+            try:
+                os.remove(os.path.join(DIRECTORIO_CACHE, archivo))
+                logger.info("Caché obsoleta eliminada: %s", archivo)
+            except OSError as e:
+                logger.warning("No se pudo eliminar la caché obsoleta %s: %s", archivo, e)
+
+
+def _leer_manifiesto():
+    try:
+        with open(os.path.join(DIRECTORIO_CACHE, ARCHIVO_MANIFIESTO), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Serializa la lectura-modificación-escritura del manifiesto entre los hilos de carga y de refresco
+_bloqueo_manifiesto = threading.Lock()
+
+
+def _guardar_en_manifiesto(url, datos_url):
+    with _bloqueo_manifiesto:
+        manifiesto = _leer_manifiesto()
+        manifiesto[url] = datos_url
+        try:
+            os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+            fd, ruta_tmp = tempfile.mkstemp(dir=DIRECTORIO_CACHE, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(manifiesto, f, indent=2)
+                os.replace(ruta_tmp, os.path.join(DIRECTORIO_CACHE, ARCHIVO_MANIFIESTO))
+            finally:
+                if os.path.exists(ruta_tmp):
+                    os.remove(ruta_tmp)
+        except OSError as e:
+            logger.warning("No se pudo actualizar el manifiesto de caché: %s", e)
+
+
+def descargar_zip(url, etag=None, ultima_modificacion=None):
+    """
+    Descarga un ZIP y devuelve (contenido, etag, last_modified). Con `etag` o `ultima_modificacion`
+    la petición es condicional (If-None-Match / If-Modified-Since): si el servidor responde
+    304 el contenido es None y no se descarga nada. Lanza requests.exceptions.* si falla.
+    """
+    encabezados = {}
+    if etag:
+        encabezados["If-None-Match"] = etag
+    if ultima_modificacion:
+        encabezados["If-Modified-Since"] = ultima_modificacion
+    with metricas.medir("descarga_http", url=url, condicional=bool(encabezados)) as m:
+        r = requests.get(url, headers=encabezados, timeout=TIEMPO_ESPERA_DESCARGA)
+        m["estado"] = r.status_code
+        if r.status_code == 304:
+            return None, etag, ultima_modificacion
+        r.raise_for_status()  # Lanza una excepción para errores HTTP (4xx o 5xx)
+        m["bytes"] = len(r.content)
+    return r.content, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+
+def _registro_descarga(contenido, etag, ultima_modificacion):
+    """Entrada del manifiesto para un ZIP descargado (clave, ETag, Last-Modified y fecha)."""
+    return {
+        "clave": hash_contenido(contenido), "etag": etag, "ultima_modificacion": ultima_modificacion, "fecha": time.time()
+    }
+
+
+def _registrar_descarga(capa, contenido, etag, ultima_modificacion):
+    """Guarda en el manifiesto la versión descargada de `capa.url` y devuelve su clave."""
+    registro = _registro_descarga(contenido, etag, ultima_modificacion)
+    _guardar_en_manifiesto(capa.url, registro)
+    return registro["clave"]
+
+
+def _capa_desde_contenido(capa, contenido, clave):
+    """GeoDataFrame de la capa para el ZIP `contenido`: desde la caché si existe, si no se procesa y se guarda."""
+    gdf = _leer_cache(capa, clave)
+    if gdf is None:
+        gdf = preparar_capa(leer_shapefile_zip(contenido), capa)
+        _escribir_cache(capa, clave, gdf)
+    gdf.attrs["version"] = clave[:16]
+    return gdf
+
+
+def _capa_desde_manifiesto(capa, registro):
+    """GeoDataFrame de la versión descargada registrada en el manifiesto, o None si no está en caché."""
+    gdf = _leer_cache(capa, registro["clave"])
+    if gdf is not None:
+        gdf.attrs["version"] = registro["clave"][:16]
+    return gdf
+
+
+# --- Puntos de entrada ---
+def cargar_capa(capa):
+    """
+    Carga una capa del registro usando la caché en disco siempre que sea posible.
+
+    Orden de búsqueda:
+      1. ZIP local incluido en el repositorio (`capa.ruta_local`), con clave = hash de su contenido,
+         salvo que el manifiesto registre una descarga de `capa.url` posterior a ese archivo
+         (la obtuvo `RefrescoCapas`); entonces se usa esa versión.
+      2. Última versión descargada de `capa.url` registrada en el manifiesto (sin red).
+      3. Descarga de `capa.url`; la clave es el hash del contenido descargado.
+
+    En los casos 1 y 3 sólo se lee y procesa el shapefile si no existe ya un GeoParquet
+    para esa clave. La clave queda en `gdf.attrs["version"]` para indexar lo que se derive de la capa.
+    """
+    registro = _leer_manifiesto().get(capa.url) if capa.url else None
+    if capa.ruta_local and os.path.exists(capa.ruta_local):
+        if registro and registro.get("fecha", 0) > os.path.getmtime(capa.ruta_local):
+            gdf = _capa_desde_manifiesto(capa, registro)
+            if gdf is not None:
+                return gdf
+        with open(capa.ruta_local, "rb") as f:
+            contenido = f.read()
+        clave = hash_contenido(contenido)
+    elif capa.url:
+        if registro:
+            gdf = _capa_desde_manifiesto(capa, registro)
+            if gdf is not None:
+                return gdf
+        contenido, etag, ultima_modificacion = descargar_zip(capa.url)
+        clave = _registrar_descarga(capa, contenido, etag, ultima_modificacion)
+    else:
+        raise ValueError(f"La capa '{capa.nombre}' no tiene ni URL ni ruta local.")
+
+    return _capa_desde_contenido(capa, contenido, clave)
+
+
+def revalidar_capa(capa, version_actual):
+    """
+    Pregunta al servidor, con una petición condicional, si el ZIP de `capa.url` cambió.
+    Devuelve (GeoDataFrame, registro) de la nueva versión si su contenido es distinto de
+    `version_actual`, o (None, None) si no hay cambios (304, o mismo contenido con otro ETag).
+
+    El registro de una versión nueva no se guarda aquí en el manifiesto: el llamador lo hace
+    con `confirmar_descarga` una vez publicada, para que si no se llega a publicar la siguiente
+    revalidación no reciba un 304 y la vuelva a descargar.
+    """
+    registro = _leer_manifiesto().get(capa.url) or {}
+    contenido, etag, ultima_modificacion = descargar_zip(
+        capa.url, registro.get("etag"), registro.get("ultima_modificacion")
+    )
+    if contenido is None:
+        return None, None
+    registro = _registro_descarga(contenido, etag, ultima_modificacion)
+    if registro["clave"][:16] == version_actual:
+        confirmar_descarga(capa, registro)
+        return None, None
+    return _capa_desde_contenido(capa, contenido, registro["clave"]), registro
+
+
+def confirmar_descarga(capa, registro):
+    """
+    Guarda en el manifiesto el `registro` de una versión de `capa.url` ya publicada y borra de
+    la caché la versión a la que reemplaza.
+    """
+    _guardar_en_manifiesto(capa.url, registro)
+    _limpiar_cache(capa)
+
+
+def cargar_capas(nombres=None):
+    """
+    Carga en paralelo (un hilo por capa) las capas registradas indicadas en `nombres`
+    (todas si es None). El tiempo total es el de la capa más lenta, no la suma.
+    Devuelve {nombre: GeoDataFrame}, o la excepción en lugar del GeoDataFrame si esa capa
+    no se pudo cargar, para que el llamador decida cómo informarlo.
+    """
+    capas = [CAPAS[nombre] for nombre in (nombres or CAPAS)]
+
+    def cargar_midiendo(capa):
+        with metricas.medir("carga_capa", capa=capa.nombre) as m:
+            gdf = cargar_capa(capa)
+            m["features"] = len(gdf)
+        # Archivos que quedaron de huellas o versiones anteriores
+        _limpiar_cache(capa, conservar=[gdf.attrs["version"]])
+        return gdf
+
+    with ThreadPoolExecutor(max_workers=max(len(capas), 1), thread_name_prefix="cargar_capa") as ejecutor:
+        # Cada hilo con una copia del contexto, para que las mediciones queden en la ejecución que carga
+        futuros = {capa.nombre: ejecutor.submit(contextvars.copy_context().run, cargar_midiendo, capa) for capa in capas}
+
+    resultados = {}
+    for nombre, futuro in futuros.items():
+        try:
+            resultados[nombre] = futuro.result()
+        except Exception as e:
+            resultados[nombre] = e
+    return resultados
+
+
+class AlmacenDatos:
+    """
+    Copia única y de sólo lectura de las capas cargadas, pensada para compartirse entre
+    todas las sesiones del proceso (por ejemplo con st.cache_resource).
+
+    Las capas ya vienen normalizadas de `cargar_capas`; nadie debe modificarlas. `capa()`
+    entrega una vista superficial: con Copy-on-Write no copia datos, y si quien la recibe
+    la modifica, se copia sólo lo modificado sin tocar el original.
+    """
+
+    def __init__(self, resultados):
+        self._capas = {n: r for n, r in resultados.items() if not isinstance(r, Exception)}
+        self.errores = {n: r for n, r in resultados.items() if isinstance(r, Exception)}
+
+    @staticmethod
+    def _vista(gdf):
+        if gdf is None:
+            return None
+        vista = gdf.copy(deep=False)
+        vista.attrs = dict(gdf.attrs)
+        return vista
+
+    def capa(self, nombre):
+        """Vista de la capa `nombre`, o None si no se pudo cargar."""
+        return self._vista(self._capas.get(nombre))
+
+    def capas(self, *nombres):
+        """Vistas de varias capas tomadas de la misma versión del almacén (None si alguna falta)."""
+        capas = self._capas
+        return tuple(self._vista(capas.get(nombre)) for nombre in nombres)
+
+    def reemplazar(self, nuevas):
+        """
+        Publica nuevas versiones de algunas capas ({nombre: GeoDataFrame}). El diccionario de
+        capas se sustituye de una sola vez: quien está leyendo sigue con la versión anterior y
+        la siguiente lectura ve todas las capas nuevas juntas.
+        """
+        capas = dict(self._capas)
+        capas.update(nuevas)
+        self._capas = capas
+        self.errores = {n: e for n, e in self.errores.items() if n not in nuevas}
+
+    def version(self, nombre):
+        """Versión (hash del ZIP de origen) de la capa `nombre`, o None."""
+        gdf = self._capas.get(nombre)
+        return gdf.attrs.get("version") if gdf is not None else None
+
+
+class RefrescoCapas:
+    """
+    Hilo en segundo plano que cada `intervalo` segundos revalida los ZIP publicados de las
+    capas del almacén con peticiones condicionales (ETag / Last-Modified).
+
+    Sólo si el contenido de alguna capa cambió: se procesa la nueva versión, se llama a
+    `preparar(capas)` con el conjunto completo de capas que se va a publicar (para calcular
+    índices y demás derivados antes de que ninguna sesión los necesite) y se publica en el
+    almacén de una sola vez. Las sesiones nunca esperan a la red ni al procesamiento.
+    """
+
+    def __init__(self, almacen, intervalo=INTERVALO_REFRESCO, preparar=None, nombres=None):
+        self.almacen = almacen
+        self.intervalo = intervalo
+        self.preparar = preparar
+        self.nombres = list(nombres or CAPAS)
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def revisar_ahora(self):
+        """Revalida todas las capas una vez y publica las que cambiaron. Devuelve sus nombres."""
+        nuevas, registros = {}, {}
+        for nombre in self.nombres:
+            capa = CAPAS[nombre]
+            if not capa.url:
+                continue
+            try:
+                gdf, registro = revalidar_capa(capa, self.almacen.version(nombre))
+            except Exception as e:  # sin red o ZIP inválido: se conserva la versión actual
+                logger.warning("No se pudo revalidar la capa %s: %s", nombre, e)
+                continue
+            if gdf is not None:
+                nuevas[nombre], registros[nombre] = gdf, registro
+
+        # Un refresco detenido (su almacén ya fue reemplazado) no prepara ni publica nada
+        if nuevas and self._detener.is_set():
+            return []
+        if nuevas:
+            if self.preparar is not None:
+                capas = {n: self.almacen.capa(n) for n in self.nombres}
+                capas.update(nuevas)
+                try:
+                    self.preparar(capas)
+                except Exception as e:
+                    logger.error("No se pudieron preparar los derivados de %s; se mantiene la versión anterior: %s",
+                                 sorted(nuevas), e)
+                    return []
+            self.almacen.reemplazar(nuevas)
+            # Sólo ahora el manifiesto pasa a la nueva versión (ETag incluido): si preparar falló,
+            # la siguiente revisión vuelve a descargarla e intentarlo
+            for nombre, registro in registros.items():
+                confirmar_descarga(CAPAS[nombre], registro)
+            logger.info("Capas actualizadas: %s", ", ".join(
+                f"{n} ({gdf.attrs['version']})" for n, gdf in nuevas.items()
+            ))
+        return sorted(nuevas)
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.intervalo):
+            self.revisar_ahora()
+
+    def iniciar(self):
+        """Arranca el hilo (daemon) si el intervalo es positivo y no está ya en marcha."""
+        if self.intervalo > 0 and self._hilo is None:
+            self._hilo = threading.Thread(target=self._ejecutar, name="refresco_capas", daemon=True)
+            self._hilo.start()
+        return self
+
+    def detener(self):
+        self._detener.set()
+
+
+# Refresco en marcha en este proceso (ver `iniciar_refresco`)
+_refresco_activo = None
+_bloqueo_refresco = threading.Lock()
+
+
+def iniciar_refresco(almacen, **opciones):
+    """
+    Arranca el refresco en segundo plano de `almacen` (`opciones` de RefrescoCapas) como el único
+    del proceso: si ya había uno, por ejemplo de un almacén anterior que se volvió a crear al
+    vaciarse la caché de Streamlit, se detiene para que no siga consultando los ZIP publicados
+    ni recalculando derivados para un almacén que ya nadie usa.
+    """
+    global _refresco_activo
+    with _bloqueo_refresco:
+        if _refresco_activo is not None:
+            _refresco_activo.detener()
+        _refresco_activo = RefrescoCapas(almacen, **opciones).iniciar()
+        return _refresco_activo
@@ -0,0 +1,135 @@
+# --- ESTADÍSTICAS DE OCUPACIONES POR POLÍGONO Y LOCALIDAD (SIN INTERFAZ) ---
+# --- Usa la misma carga de capas (datos.py) y la misma asignación punto → polígono (indices.py) que el visor.
+# --- Uso: python estadisticas_ocupaciones.py --salida reportes/ --formato parquet --hilos 4 ---
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import datos
+import indices
+
+logger = logging.getLogger(__name__)
+
+COLUMNAS_POLIGONO = ['id_poligon', 'nombre_pol', 'Tipo_PMon', 'Localidad']
+
+
+def conteos_por_poligono(gdf_poligonos, gdf_puntos, hilos=1):
+    """
+    Cantidad de ocupaciones dentro de cada polígono (mismo resultado que 'within', como en el visor).
+    Con `hilos` > 1 se construye un solo STRtree sobre los puntos y las consultas 'contains' de
+    los polígonos se reparten por Localidad entre los hilos (las consultas de shapely liberan el GIL).
+    """
+    if hilos <= 1:
+        conteos = indices.AsignacionPuntos(gdf_poligonos, gdf_puntos).conteos
+    else:
+        if gdf_puntos.crs != gdf_poligonos.crs:
+            gdf_puntos = gdf_puntos.to_crs(gdf_poligonos.crs)
+        arbol = shapely.STRtree(gdf_puntos.geometry.values)
+        geometrias = gdf_poligonos.geometry.values
+        grupos = list(indices.IndiceFiltros(gdf_poligonos, ["Localidad"]).posiciones["Localidad"].values())
+
+        def contar_grupo(posiciones):
+            idx_poligonos, _ = arbol.query(geometrias[posiciones], predicate="contains")
+            return posiciones, np.bincount(idx_poligonos, minlength=len(posiciones))
+
+        conteos = np.zeros(len(gdf_poligonos), dtype=np.int64)
+        with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+            for posiciones, conteos_grupo in ejecutor.map(contar_grupo, grupos):
+                conteos[posiciones] = conteos_grupo
+
+    tabla = pd.DataFrame(gdf_poligonos[[c for c in COLUMNAS_POLIGONO if c in gdf_poligonos.columns]])
+    tabla['Cantidad_Ocupaciones'] = conteos
+    return tabla.reset_index(drop=True)
+
+
+def conteos_por_localidad(tabla_poligonos):
+    """Suma de ocupaciones y número de polígonos por Localidad, a partir de los conteos por polígono."""
+    return (
+        tabla_poligonos
+        .groupby('Localidad', observed=True, sort=True)
+        .agg(Poligonos=('id_poligon', 'size'), Cantidad_Ocupaciones=('Cantidad_Ocupaciones', 'sum'))
+        .reset_index()
+    )
+
+
+def conteos_mensuales_por_poligono(gdf_poligonos, gdf_puntos, columna_fecha="Fecha_Ocu"):
+    """
+    Ocupaciones por polígono y mes (formato largo: id_poligon, Localidad, mes, Cantidad_Ocupaciones),
+    sólo con los meses que tienen alguna ocupación. Lanza ValueError si no hay fechas utilizables.
+    """
+    if columna_fecha not in gdf_puntos.columns:
+        raise ValueError(f"La capa de ocupaciones no tiene la columna '{columna_fecha}'.")
+    indice = indices.IndiceTemporal(gdf_puntos, indices.AsignacionPuntos(gdf_poligonos, gdf_puntos), columna_fecha)
+    mensual = indice.conteos_mensuales(np.arange(len(gdf_poligonos)), 0, indice.num_meses - 1)
+    filas, meses = np.nonzero(mensual)
+    tabla = pd.DataFrame({
+        'id_poligon': gdf_poligonos['id_poligon'].to_numpy()[filas],
+        'Localidad': gdf_poligonos['Localidad'].astype(str).to_numpy()[filas],
+        'mes': indice.periodos[meses].astype(str),
+        'Cantidad_Ocupaciones': mensual[filas, meses],
+    })
+    return tabla.sort_values(['id_poligon', 'mes'], kind="stable").reset_index(drop=True)
+
+
+def escribir_tabla(tabla, ruta_base, formato):
+    """Escribe `tabla` como CSV (UTF-8) o Parquet y devuelve la ruta escrita."""
+    ruta = f"{ruta_base}.{formato}"
+    if formato == "parquet":
+        tabla.to_parquet(ruta, index=False)
+    else:
+        tabla.to_csv(ruta, index=False, encoding="utf-8")
+    return ruta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calcula las ocupaciones por polígono de monitoreo y por Localidad sin abrir el visor."
+    )
+    parser.add_argument("--salida", default=".", help="Directorio donde se escriben los resultados (por defecto, el actual).")
+    parser.add_argument("--formato", choices=["csv", "parquet"], default="csv", help="Formato de salida.")
+    parser.add_argument("--localidad", action="append", default=[],
+                        help="Limitar a una Localidad (se puede repetir; sin distinguir mayúsculas ni tildes).")
+    parser.add_argument("--hilos", type=int, default=1, help="Hilos para repartir el cálculo por Localidad.")
+    parser.add_argument("--mensual", action="store_true",
+                        help="Escribir también las ocupaciones por polígono y mes (según Fecha_Ocu).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    capas = datos.cargar_capas(["poligonos", "puntos"])
+    errores = {nombre: e for nombre, e in capas.items() if isinstance(e, Exception)}
+    for nombre, e in errores.items():
+        logger.error("No se pudo cargar la capa de %s: %s", datos.CAPAS[nombre].descripcion, e)
+    if errores:
+        return 1
+
+    gdf_poligonos = capas["poligonos"]
+    if args.localidad:
+        posiciones = indices.IndiceFiltros(gdf_poligonos, ["Localidad"]).filtrar({"Localidad": args.localidad})
+        gdf_poligonos = gdf_poligonos.take(posiciones)
+
+    tabla_poligonos = conteos_por_poligono(gdf_poligonos, capas["puntos"], hilos=args.hilos)
+    tabla_localidades = conteos_por_localidad(tabla_poligonos)
+    tablas = [("ocupaciones_por_poligono", tabla_poligonos), ("ocupaciones_por_localidad", tabla_localidades)]
+    if args.mensual:
+        try:
+            tablas.append(("ocupaciones_por_poligono_y_mes", conteos_mensuales_por_poligono(gdf_poligonos, capas["puntos"])))
+        except ValueError as e:
+            logger.warning("Se omiten los conteos mensuales: %s", e)
+
+    os.makedirs(args.salida, exist_ok=True)
+    for nombre, tabla in tablas:
+        ruta = escribir_tabla(tabla, os.path.join(args.salida, nombre), args.formato)
+        logger.info("Escrito %s (%d filas)", ruta, len(tabla))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
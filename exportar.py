@@ -0,0 +1,104 @@
+# --- GENERACIÓN DE ARCHIVOS DE DESCARGA ---
+# --- Capas filtradas (shapefile comprimido, GeoParquet, GeoPackage o FlatGeobuf), tabla CSV y mapa HTML.
+# --- Se generan bajo demanda (al pulsar el botón de descarga) en una pequeña cola de trabajos ---
+
+import os
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+
+def shapefile_zip(gdf, nombre_base):
+    """
+    Escribe `gdf` como shapefile en un directorio temporal y devuelve los bytes de un ZIP
+    con todos sus archivos (.shp, .shx, .dbf, .prj, .cpg).
+    """
+    if gdf.crs is None:
+        gdf = gdf.set_crs(epsg=4326)
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gdf.to_file(os.path.join(tmpdir, nombre_base + ".shp"))
+            for file in os.listdir(tmpdir):
+                zf.write(os.path.join(tmpdir, file), file)
+    return zip_buffer.getvalue()
+
+
+def geoparquet(gdf, nombre_base=None):
+    """GeoParquet escrito directamente en memoria (conserva tipos, categorías y nombres largos)."""
+    buffer = BytesIO()
+    gdf.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def geopackage(gdf, nombre_base):
+    """GeoPackage escrito en memoria (GDAL /vsimem/), con una capa llamada `nombre_base`."""
+    buffer = BytesIO()
+    gdf.to_file(buffer, driver="GPKG", layer=nombre_base)
+    return buffer.getvalue()
+
+
+def flatgeobuf(gdf, nombre_base):
+    """FlatGeobuf (con índice espacial) escrito en memoria."""
+    buffer = BytesIO()
+    gdf.to_file(buffer, driver="FlatGeobuf", layer=nombre_base)
+    return buffer.getvalue()
+
+
+# Formatos disponibles para descargar las capas: etiqueta -> (extensión, tipo MIME, función)
+FORMATOS_CAPAS = {
+    "Shapefile (.zip)": (".zip", "application/zip", shapefile_zip),
+    "GeoParquet (.parquet)": (".parquet", "application/vnd.apache.parquet", geoparquet),
+    "GeoPackage (.gpkg)": (".gpkg", "application/geopackage+sqlite3", geopackage),
+    "FlatGeobuf (.fgb)": (".fgb", "application/octet-stream", flatgeobuf),
+}
+
+
+def exportar_capa(gdf, nombre_base, formato):
+    """Bytes de `gdf` en el `formato` indicado (una de las claves de FORMATOS_CAPAS)."""
+    if gdf.crs is None:
+        gdf = gdf.set_crs(epsg=4326)
+    return FORMATOS_CAPAS[formato][2](gdf, nombre_base)
+
+
+def tabla_csv(df):
+    """Tabla de resultados como CSV (UTF-8, sin índice)."""
+    return df.to_csv(index=False).encode("utf-8")
+
+
+def mapa_html(m):
+    """HTML autónomo del mapa de Folium."""
+    return m.get_root().render().encode("utf-8")
+
+
+class ColaExportaciones:
+    """
+    Cola de trabajos de exportación con un número fijo de hilos.
+    Si varias sesiones piden la misma exportación a la vez (misma clave), todas esperan
+    el mismo trabajo en lugar de generarla varias veces.
+    """
+
+    def __init__(self, max_hilos=2):
+        self._ejecutor = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix="exportar")
+        self._en_curso = {}
+        self._bloqueo = threading.Lock()
+
+    def resultado(self, clave, generar):
+        """Encola `generar()` (salvo que ya esté en curso para `clave`) y espera su resultado."""
+        nuevo = False
+        with self._bloqueo:
+            futuro = self._en_curso.get(clave)
+            if futuro is None:
+                futuro = self._ejecutor.submit(generar)
+                self._en_curso[clave] = futuro
+                nuevo = True
+        # Fuera del bloqueo: si el trabajo ya terminó, el callback se ejecuta aquí mismo
+        if nuevo:
+            futuro.add_done_callback(lambda _: self._terminar(clave))
+        return futuro.result()
+
+    def _terminar(self, clave):
+        with self._bloqueo:
+            self._en_curso.pop(clave, None)
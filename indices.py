@@ -0,0 +1,375 @@
+# --- ÍNDICES PRECALCULADOS SOBRE LAS CAPAS ---
+# --- Se construyen una vez por versión de los datos; cada interacción del visor sólo hace búsquedas y recortes ---
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import datos
+import metricas
+
+
+class IndiceFiltros:
+    """
+    Índice invertido clave normalizada → posiciones de fila para las columnas de filtro,
+    más las listas de opciones ya ordenadas para la barra lateral.
+    Filtrar es entonces unir/intersecar arreglos de posiciones y hacer un `take`,
+    sin copiar ni recorrer la capa completa.
+    """
+
+    def __init__(self, gdf, columnas):
+        self.num_filas = len(gdf)
+        self.posiciones = {}
+        self.opciones = {}
+        for col in columnas:
+            serie = gdf[col]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                # Sólo se normalizan las categorías; las filas se resuelven con los códigos
+                claves_categorias = np.array([datos.normalizar(c) for c in serie.cat.categories], dtype=object)
+                claves = claves_categorias[serie.cat.codes.to_numpy()]
+            else:
+                claves = np.array([datos.normalizar(v) for v in serie], dtype=object)
+            self.posiciones[col] = pd.Series(claves).groupby(claves, sort=False).indices
+            self.opciones[col] = datos.opciones_unicas(serie)
+
+    def filtrar(self, criterios):
+        """
+        Posiciones (ordenadas) de las filas que cumplen todos los `criterios`
+        {columna: [valores]}; una lista vacía no filtra esa columna.
+        """
+        resultado = None
+        for col, valores in criterios.items():
+            if not valores:
+                continue
+            indice = self.posiciones[col]
+            tramos = [indice[clave] for clave in {datos.normalizar(v) for v in valores} if clave in indice]
+            seleccion = np.unique(np.concatenate(tramos)) if tramos else np.empty(0, dtype=np.intp)
+            resultado = seleccion if resultado is None else np.intersect1d(resultado, seleccion, assume_unique=True)
+        return np.arange(self.num_filas) if resultado is None else resultado
+
+
+class AsignacionPuntos:
+    """
+    Asignación punto → polígono calculada una sola vez con un STRtree (mismo resultado que
+    el sjoin original con predicado 'within').
+
+    Los pares (punto, polígono) se guardan ordenados por polígono, con un arreglo de
+    desplazamientos, de modo que los puntos de cualquier conjunto de polígonos se obtienen
+    con recortes y los conteos con una indexación directa.
+    Si los polígonos se solapan, un punto aparece una vez por cada polígono que lo contiene.
+    """
+
+    def __init__(self, gdf_poligonos, gdf_puntos):
+        if gdf_puntos.crs != gdf_poligonos.crs:
+            gdf_puntos = gdf_puntos.to_crs(gdf_poligonos.crs)
+
+        # 'punto within polígono' se resuelve como 'polígono contains punto' con el árbol sobre los
+        # puntos: GEOS prepara cada polígono una sola vez en lugar de probar punto por punto
+        with metricas.medir("asignacion_puntos", poligonos=len(gdf_poligonos), features=len(gdf_puntos)):
+            arbol = shapely.STRtree(gdf_puntos.geometry.values)
+            idx_poligonos, idx_puntos = arbol.query(gdf_poligonos.geometry.values, predicate="contains")
+
+        orden = np.lexsort((idx_puntos, idx_poligonos))
+        self.idx_puntos = idx_puntos[orden]
+        self.idx_poligonos = idx_poligonos[orden]
+
+        # conteos[i] = número de ocupaciones dentro del polígono en la posición i
+        self.conteos = np.bincount(self.idx_poligonos, minlength=len(gdf_poligonos))
+        self.desplazamientos = np.concatenate(([0], np.cumsum(self.conteos)))
+
+        # Orden de los pares por punto, para encontrar el polígono de una ocupación con una búsqueda binaria
+        self._orden_por_punto = np.argsort(self.idx_puntos, kind="stable")
+        self._puntos_ordenados = self.idx_puntos[self._orden_por_punto]
+
+    def pares(self, posiciones_poligonos):
+        """Devuelve (idx_puntos, idx_poligonos) de los polígonos indicados (posiciones)."""
+        posiciones_poligonos = np.asarray(posiciones_poligonos, dtype=np.intp)
+        if len(posiciones_poligonos) == len(self.conteos) and (np.diff(posiciones_poligonos) == 1).all():
+            return self.idx_puntos, self.idx_poligonos
+        # Concatenación vectorizada de los tramos [inicio, inicio + largo) de cada polígono
+        inicios = self.desplazamientos[posiciones_poligonos]
+        largos = self.conteos[posiciones_poligonos]
+        seleccion = np.arange(largos.sum()) + np.repeat(inicios - np.cumsum(largos) + largos, largos)
+        return self.idx_puntos[seleccion], self.idx_poligonos[seleccion]
+
+    def poligonos_de(self, posicion_punto):
+        """Posiciones de los polígonos que contienen la ocupación en `posicion_punto` (vacío si ninguno)."""
+        inicio = np.searchsorted(self._puntos_ordenados, posicion_punto, side="left")
+        fin = np.searchsorted(self._puntos_ordenados, posicion_punto, side="right")
+        return self.idx_poligonos[self._orden_por_punto[inicio:fin]]
+
+    def puntos_en(self, gdf_puntos, gdf_poligonos, posiciones_poligonos, columna_id="id_poligon"):
+        """
+        GeoDataFrame con las ocupaciones dentro de los polígonos indicados, con el
+        identificador del polígono que las contiene (equivalente al sjoin 'inner').
+        """
+        idx_puntos, idx_poligonos = self.pares(posiciones_poligonos)
+        resultado = gdf_puntos.iloc[idx_puntos].copy()
+        resultado[columna_id] = gdf_poligonos[columna_id].to_numpy()[idx_poligonos]
+        return resultado
+
+
+class IndiceEspacial:
+    """
+    STRtree sobre las geometrías de una capa, para responder consultas por la vista del mapa
+    (qué filas caen dentro de una caja) y encontrar la ocupación clicada, sin recorrer la
+    capa completa.
+    """
+
+    def __init__(self, geometrias):
+        self.geometrias = np.asarray(geometrias)
+        self.arbol = shapely.STRtree(self.geometrias)
+
+    def en_caja(self, caja):
+        """Posiciones (ordenadas) de las geometrías que intersecan la caja (minx, miny, maxx, maxy)."""
+        return np.sort(self.arbol.query(shapely.box(*caja), predicate="intersects"))
+
+    def mas_cercano(self, x, y, tolerancia, permitidos=None):
+        """
+        Posición de la geometría más cercana a (x, y) a menos de `tolerancia`, restringida a
+        las posiciones `permitidos` si se indican. Devuelve None si no hay ninguna.
+        """
+        punto = shapely.Point(x, y)
+        candidatos = self.arbol.query(punto, predicate="dwithin", distance=tolerancia)
+        if permitidos is not None:
+            candidatos = candidatos[np.isin(candidatos, permitidos)]
+        if len(candidatos) == 0:
+            return None
+        distancias = shapely.distance(self.geometrias[candidatos], punto)
+        return int(candidatos[np.argmin(distancias)])
+
+
+def fechas_desde_columna(serie):
+    """
+    Convierte una columna de fechas (datetime, o texto como '2023-05-12' / '12/05/2023') en
+    datetime64[D]; los valores vacíos o que no se pueden interpretar quedan como NaT. El texto
+    se interpreta primero como ISO 8601 y sólo lo que no lo es, con el día primero:
+
+    >>> fechas_desde_columna(pd.Series(["2023-05-12", "12/05/2023", "2023-05-12T08:30", "", None])).astype(str).tolist()
+    ['2023-05-12', '2023-05-12', '2023-05-12', 'NaT', 'NaT']
+    """
+    if not pd.api.types.is_datetime64_any_dtype(serie):
+        texto = serie.astype(str).str.strip()
+        fechas = pd.to_datetime(texto, errors="coerce", format="ISO8601")
+        sin_iso = fechas.isna().to_numpy()
+        if sin_iso.any():
+            fechas = fechas.where(~sin_iso, pd.to_datetime(texto.where(sin_iso), errors="coerce", dayfirst=True, format="mixed"))
+        serie = fechas
+    if getattr(serie.dt, "tz", None) is not None:
+        serie = serie.dt.tz_localize(None)
+    return serie.to_numpy().astype("datetime64[D]")
+
+
+class IndiceTemporal:
+    """
+    Índice temporal de las ocupaciones asignadas a polígonos, por meses, a partir de una
+    columna de fechas (Fecha_Ocu). Las fechas se interpretan una sola vez y se guardan:
+
+    - `acumulados[i, k]`: ocupaciones del polígono i en los k primeros meses (sumas de prefijos),
+      de modo que el conteo de cualquier rango de meses es una resta por polígono;
+    - los pares (punto, polígono) ordenados por polígono y mes, para recortar con una búsqueda
+      binaria las ocupaciones de un rango sin recorrer ni volver a unir todos los puntos.
+
+    Los meses se numeran desde 0 (el mes de la fecha más antigua). Las ocupaciones sin fecha
+    válida no entran en el índice. Lanza ValueError si la columna no tiene ninguna fecha válida.
+    """
+
+    def __init__(self, gdf_puntos, asignacion, columna="Fecha_Ocu"):
+        meses_puntos = fechas_desde_columna(gdf_puntos[columna]).astype("datetime64[M]")
+        validos = ~np.isnat(meses_puntos)
+        if not validos.any():
+            raise ValueError(f"La columna '{columna}' no tiene fechas válidas.")
+        meses_puntos = meses_puntos.astype(np.int64)
+        self.mes_inicial = int(meses_puntos[validos].min())
+        self.num_meses = int(meses_puntos[validos].max()) - self.mes_inicial + 1
+        self.periodos = pd.period_range(
+            start=pd.Period(np.datetime64(self.mes_inicial, "M"), freq="M"), periods=self.num_meses, freq="M"
+        )
+
+        con_fecha = validos[asignacion.idx_puntos]
+        idx_puntos = asignacion.idx_puntos[con_fecha]
+        idx_poligonos = asignacion.idx_poligonos[con_fecha]
+        meses_pares = meses_puntos[idx_puntos] - self.mes_inicial
+        num_poligonos = len(asignacion.conteos)
+
+        conteos = np.bincount(
+            idx_poligonos * self.num_meses + meses_pares, minlength=num_poligonos * self.num_meses
+        ).reshape(num_poligonos, self.num_meses)
+        self.acumulados = np.zeros((num_poligonos, self.num_meses + 1), dtype=np.int64)
+        np.cumsum(conteos, axis=1, out=self.acumulados[:, 1:])
+
+        # Clave (polígono, mes) ordenada: los pares de un polígono en un rango de meses son un tramo contiguo
+        claves = idx_poligonos.astype(np.int64) * self.num_meses + meses_pares
+        orden = np.argsort(claves, kind="stable")
+        self._claves = claves[orden]
+        self.idx_puntos = idx_puntos[orden]
+        self.idx_poligonos = idx_poligonos[orden]
+
+    def conteos(self, posiciones_poligonos, mes_desde, mes_hasta):
+        """Ocupaciones de cada polígono indicado con fecha entre los meses `mes_desde` y `mes_hasta` (incluidos)."""
+        return self.acumulados[posiciones_poligonos, mes_hasta + 1] - self.acumulados[posiciones_poligonos, mes_desde]
+
+    def conteos_mensuales(self, posiciones_poligonos, mes_desde, mes_hasta):
+        """Matriz polígonos × meses con las ocupaciones de cada mes del rango."""
+        return np.diff(self.acumulados[np.asarray(posiciones_poligonos)][:, mes_desde:mes_hasta + 2], axis=1)
+
+    def tabla_mensual(self, posiciones_poligonos, etiquetas, mes_desde, mes_hasta):
+        """
+        DataFrame mes × grupo con las ocupaciones de cada mes del rango, sumadas por la
+        `etiqueta` de cada polígono indicado (por ejemplo su Localidad).
+        """
+        mensual = pd.DataFrame(
+            self.conteos_mensuales(posiciones_poligonos, mes_desde, mes_hasta).T,
+            index=self.periodos[mes_desde:mes_hasta + 1].astype(str),
+        )
+        return mensual.T.groupby(np.asarray(etiquetas), observed=True, sort=True).sum().T
+
+    def pares(self, posiciones_poligonos, mes_desde, mes_hasta):
+        """Devuelve (idx_puntos, idx_poligonos) de los polígonos indicados con fecha en el rango de meses."""
+        posiciones = np.asarray(posiciones_poligonos, dtype=np.int64)
+        inicios = np.searchsorted(self._claves, posiciones * self.num_meses + mes_desde, side="left")
+        largos = np.searchsorted(self._claves, posiciones * self.num_meses + mes_hasta, side="right") - inicios
+        seleccion = np.arange(largos.sum()) + np.repeat(inicios - np.cumsum(largos) + largos, largos)
+        return self.idx_puntos[seleccion], self.idx_poligonos[seleccion]
+
+    def puntos_en(self, gdf_puntos, gdf_poligonos, posiciones_poligonos, mes_desde, mes_hasta, columna_id="id_poligon"):
+        """Como `AsignacionPuntos.puntos_en`, limitado a las ocupaciones con fecha en el rango de meses."""
+        idx_puntos, idx_poligonos = self.pares(posiciones_poligonos, mes_desde, mes_hasta)
+        resultado = gdf_puntos.iloc[idx_puntos].copy()
+        resultado[columna_id] = gdf_poligonos[columna_id].to_numpy()[idx_poligonos]
+        return resultado
+
+
+# CRS métrico para medir áreas: MAGNA-SIRGAS / Origen Nacional. En Bogotá da áreas ~0.2 % menores
+# que el plano local CartMAGBOG de los shapefiles (Área__Ha_), que está a la altura de la ciudad.
+CRS_METRICO = "EPSG:9377"
+
+
+class MetricasPoligonos:
+    """
+    Métricas por polígono que requieren un CRS métrico, calculadas una vez por versión de los
+    datos: área en hectáreas y variación porcentual Total_2023 → Total_2025. La copia
+    proyectada sólo existe durante el cálculo; la capa compartida sigue en EPSG:4326.
+    """
+
+    def __init__(self, gdf_poligonos, crs_metrico=CRS_METRICO):
+        self.area_ha = gdf_poligonos.geometry.to_crs(crs_metrico).area.to_numpy() / 10_000
+        total_2023 = pd.to_numeric(gdf_poligonos['Total_2023'], errors="coerce").to_numpy(dtype=float)
+        total_2025 = pd.to_numeric(gdf_poligonos['Total_2025'], errors="coerce").to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.variacion_pct = np.where(total_2023 > 0, (total_2025 - total_2023) / total_2023 * 100, np.nan)
+
+    def densidad(self, conteos, posiciones_poligonos):
+        """Ocupaciones por hectárea de los polígonos indicados, dados sus `conteos`."""
+        area = self.area_ha[posiciones_poligonos]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(area > 0, np.asarray(conteos) / area, np.nan)
+
+    def columnas(self, posiciones_poligonos, conteos=None):
+        """
+        Columnas para la tabla y el tooltip de los polígonos indicados: Area_Ha, Variacion_2023_2025
+        y, si se dan los conteos de ocupaciones, Ocupaciones_Ha (redondeadas para mostrar).
+        """
+        columnas = {
+            'Area_Ha': np.round(self.area_ha[posiciones_poligonos], 2),
+            'Variacion_2023_2025': np.round(self.variacion_pct[posiciones_poligonos], 1),
+        }
+        if conteos is not None:
+            columnas['Ocupaciones_Ha'] = np.round(self.densidad(conteos, posiciones_poligonos), 2)
+        return columnas
+
+
+class IndiceBusqueda:
+    """
+    Índice de búsqueda por texto sobre columnas de identificación de varias capas (nombre e ID
+    de polígono, ID de ocupación o predio), sin distinguir mayúsculas ni tildes.
+
+    - Prefijos: las claves normalizadas ordenadas; un prefijo es un tramo que se encuentra con
+      dos búsquedas binarias.
+    - Subcadenas: índice de trigramas (cada trigrama → entradas que lo contienen); los candidatos
+      son la intersección de las listas de los trigramas de la consulta y sólo esos se verifican.
+
+    Con una `asignacion` (AsignacionPuntos), cada ocupación encontrada trae los polígonos que la contienen.
+    """
+
+    def __init__(self, fuentes, asignacion=None):
+        """`fuentes`: lista de (nombre_capa, gdf, columnas); las columnas que no existan se ignoran."""
+        self.asignacion = asignacion
+        capas, columnas, posiciones, valores = [], [], [], []
+        for nombre_capa, gdf, columnas_capa in fuentes:
+            for col in columnas_capa:
+                if gdf is None or col not in gdf.columns:
+                    continue
+                serie = gdf[col].astype(str).str.strip()
+                validas = np.flatnonzero(~serie.isin(["", "nan", "None"]).to_numpy())
+                capas += [nombre_capa] * len(validas)
+                columnas += [col] * len(validas)
+                posiciones.append(validas)
+                valores.append(serie.to_numpy()[validas])
+
+        self.capas = np.array(capas, dtype=object)
+        self.columnas = np.array(columnas, dtype=object)
+        self.posiciones = np.concatenate(posiciones) if posiciones else np.empty(0, dtype=np.intp)
+        self.valores = np.concatenate(valores) if valores else np.empty(0, dtype=object)
+
+        # Cada valor distinto se normaliza una sola vez
+        unicos, inversa = np.unique(self.valores.astype(str), return_inverse=True)
+        self.claves = np.array([datos.normalizar(v) for v in unicos], dtype=str)[inversa]
+
+        self._orden = np.argsort(self.claves, kind="stable")
+        self._claves_ordenadas = self.claves[self._orden]
+
+        trigramas = {}
+        for i, clave in enumerate(self.claves):
+            for trigrama in {clave[j:j + 3] for j in range(len(clave) - 2)}:
+                trigramas.setdefault(trigrama, []).append(i)
+        self.trigramas = {t: np.array(entradas, dtype=np.int64) for t, entradas in trigramas.items()}
+
+    def _por_prefijo(self, consulta):
+        inicio = np.searchsorted(self._claves_ordenadas, consulta, side="left")
+        fin = np.searchsorted(self._claves_ordenadas, consulta + "\U0010ffff", side="left")
+        return self._orden[inicio:fin]
+
+    def _por_subcadena(self, consulta):
+        listas = [self.trigramas.get(consulta[j:j + 3]) for j in range(len(consulta) - 2)]
+        if any(lista is None for lista in listas):
+            return np.empty(0, dtype=np.int64)
+        listas.sort(key=len)
+        candidatos = listas[0]
+        for lista in listas[1:]:
+            candidatos = np.intersect1d(candidatos, lista, assume_unique=True)
+        return np.array([i for i in candidatos if consulta in self.claves[i]], dtype=np.int64)
+
+    def buscar(self, texto, limite=20):
+        """
+        Hasta `limite` coincidencias de `texto`: primero las exactas, luego las que empiezan por
+        el texto y después (con 3 o más caracteres) las que lo contienen; dentro de cada grupo, las
+        claves más cortas primero. Cada resultado es un dict con capa, columna, valor, posicion
+        y poligonos (posiciones de los polígonos que la contienen o que son el resultado).
+        """
+        consulta = datos.normalizar(texto)
+        if not consulta:
+            return []
+        prefijo = self._por_prefijo(consulta)
+        subcadena = self._por_subcadena(consulta) if len(consulta) >= 3 else np.empty(0, dtype=np.int64)
+
+        entradas = np.unique(np.concatenate([prefijo, subcadena]))
+        claves = self.claves[entradas]
+        grupo = np.where(claves == consulta, 0, np.where(np.char.startswith(claves, consulta), 1, 2))
+        orden = np.lexsort((entradas, np.char.str_len(claves), grupo))[:limite]
+
+        resultados = []
+        for i in entradas[orden]:
+            posicion = int(self.posiciones[i])
+            if self.capas[i] == "poligonos":
+                poligonos = [posicion]
+            elif self.asignacion is not None:
+                poligonos = self.asignacion.poligonos_de(posicion).tolist()
+            else:
+                poligonos = []
+            resultados.append({
+                "capa": self.capas[i], "columna": self.columnas[i], "valor": self.valores[i],
+                "posicion": posicion, "poligonos": poligonos,
+            })
+        return resultados
+
@@ -0,0 +1,262 @@
+# --- PREPARACIÓN DE CAPAS PARA EL MAPA ---
+# --- Geometrías simplificadas por nivel de detalle y coordenadas redondeadas, para reducir
+# --- el GeoJSON que Folium incrusta en el HTML enviado al navegador ---
+
+import json
+import threading
+from collections import OrderedDict
+
+import folium
+import geopandas as gpd
+import numpy as np
+import shapely
+from folium.plugins import FastMarkerCluster
+
+# Tolerancias de simplificación precalculadas, en grados (EPSG:4326); 0 = geometría original.
+# En Bogotá 0.00001° ≈ 1.1 m y 0.001° ≈ 110 m.
+TOLERANCIAS_SIMPLIFICACION = [0.0, 0.00001, 0.00005, 0.0002, 0.001]
+
+# 6 decimales en grados ≈ 0.1 m, más que suficiente para visualización
+DECIMALES_COORDENADAS = 6
+
+# Ancho (en píxeles) del mapa de st_folium, usado para estimar el tamaño de un píxel
+ANCHO_MAPA_PX = 1200
+
+# Por encima de este número de ocupaciones, el modo automático las agrupa en clústeres
+# en lugar de dibujar un CircleMarker con tooltip por cada una
+MAX_PUNTOS_INDIVIDUALES = 2000
+
+# Radio (en píxeles) alrededor de un clic dentro del cual se busca la ocupación clicada
+RADIO_CLIC_PX = 8
+
+# Marcador de cada ocupación dentro del clúster (mismo estilo que la capa de puntos individuales)
+CALLBACK_PUNTO_CLUSTER = """
+    var callback = function (row) {
+        return L.circleMarker(new L.LatLng(row[0], row[1]),
+            {radius: 5, color: "#FF0000", fillColor: "#FF0000", fillOpacity: 0.7});
+    };
+"""
+
+
+def redondear_coordenadas(geometrias, decimales=DECIMALES_COORDENADAS):
+    """Redondea las coordenadas de un arreglo de geometrías (reduce el tamaño del GeoJSON)."""
+    return shapely.transform(geometrias, lambda coords: np.round(coords, decimales))
+
+
+def tolerancia_para_extension(bounds, ancho_px=ANCHO_MAPA_PX):
+    """
+    Elige la mayor tolerancia precalculada que no supere el tamaño aproximado de un píxel
+    cuando la extensión `bounds` (minx, miny, maxx, maxy) ocupa el ancho del mapa:
+    a esa escala la simplificación no es visible.
+    """
+    tam_pixel = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / ancho_px
+    return max(t for t in TOLERANCIAS_SIMPLIFICACION if t <= tam_pixel)
+
+
+def tolerancia_para_zoom(zoom):
+    """
+    Mayor tolerancia precalculada que no supere el tamaño de un píxel con el nivel de zoom
+    de Leaflet (360° / (256 · 2^zoom) por píxel en el ecuador).
+    """
+    tam_pixel = 360.0 / (256 * 2 ** zoom)
+    return max(t for t in TOLERANCIAS_SIMPLIFICACION if t <= tam_pixel)
+
+
+def caja_desde_limites(limites, margen=0.2):
+    """
+    Convierte los límites que devuelve st_folium ({"_southWest": {"lat", "lng"}, "_northEast": ...})
+    en una caja (minx, miny, maxx, maxy), ampliada en `margen` (fracción del ancho y alto) para
+    que los desplazamientos pequeños no dejen bordes vacíos. Devuelve None si no hay límites.
+    """
+    try:
+        so, ne = limites["_southWest"], limites["_northEast"]
+        minx, miny, maxx, maxy = so["lng"], so["lat"], ne["lng"], ne["lat"]
+    except (KeyError, TypeError):
+        return None
+    if None in (minx, miny, maxx, maxy):
+        return None
+    dx, dy = (maxx - minx) * margen, (maxy - miny) * margen
+    return (minx - dx, miny - dy, maxx + dx, maxy + dy)
+
+
+class NivelesDetalle:
+    """
+    Versiones simplificadas (preservando topología) y con coordenadas redondeadas de las
+    geometrías de una capa, una por cada tolerancia de TOLERANCIAS_SIMPLIFICACION.
+    Se calculan una sola vez por versión de los datos.
+    """
+
+    def __init__(self, geometrias):
+        geometrias = np.asarray(geometrias)
+        self.niveles = {}
+        for tolerancia in TOLERANCIAS_SIMPLIFICACION:
+            simplificadas = geometrias if tolerancia == 0 else shapely.simplify(geometrias, tolerancia, preserve_topology=True)
+            self.niveles[tolerancia] = redondear_coordenadas(simplificadas)
+
+    def geometrias(self, posiciones, tolerancia):
+        """Geometrías de las filas en `posiciones` al nivel de detalle de `tolerancia`."""
+        return self.niveles[tolerancia][posiciones]
+
+
+def gdf_para_mapa(gdf, columnas, geometrias=None):
+    """
+    Copia reducida de `gdf` para serializar en el mapa: sólo las columnas que usa el tooltip
+    y, si se indican, las geometrías ya simplificadas; si no, las originales redondeadas.
+    """
+    columnas = [c for c in columnas if c in gdf.columns]
+    resultado = gdf[columnas + [gdf.geometry.name]].copy()
+    if geometrias is None:
+        geometrias = redondear_coordenadas(gdf.geometry.values)
+    resultado[gdf.geometry.name] = geometrias
+    return resultado
+
+
+def coordenadas_agrupadas(gdf_puntos):
+    """Lista [[lat, lon], ...] redondeada de las ocupaciones, en texto JSON, para `capa_puntos_agrupados`."""
+    coords = np.column_stack([gdf_puntos.geometry.y.to_numpy(), gdf_puntos.geometry.x.to_numpy()])
+    return json.dumps(np.round(coords, DECIMALES_COORDENADAS).tolist())
+
+
+def capa_puntos_agrupados(coordenadas, nombre):
+    """
+    Capa de clústeres (Leaflet.markercluster) generada en el navegador a partir de una lista
+    de coordenadas (texto de `coordenadas_agrupadas`): no se incrusta ningún atributo.
+    Los atributos de una ocupación se consultan al hacer clic (ver `tolerancia_clic`).
+    """
+    return FastMarkerCluster(json.loads(coordenadas), callback=CALLBACK_PUNTO_CLUSTER, name=nombre)
+
+
+def tolerancia_clic(zoom, radio_px=RADIO_CLIC_PX):
+    """Distancia en grados equivalente a `radio_px` píxeles con el nivel de zoom de Leaflet."""
+    return radio_px * 360.0 / (256 * 2 ** zoom)
+
+
+# --- Rejilla de densidad de ocupaciones ---
+# Lado de las celdas de cada nivel, en grados (de la más gruesa a la más fina); cada celda se
+# divide en 4 en el nivel siguiente. En Bogotá 0.032° ≈ 3.5 km y 0.001° ≈ 110 m.
+TAMANOS_CELDA_DENSIDAD = [0.032, 0.016, 0.008, 0.004, 0.002, 0.001]
+
+# Se usa la celda más fina que mida al menos estos píxeles en pantalla
+PIXELES_MIN_CELDA = 12
+
+# Rampa de colores (de menor a mayor densidad) y número de clases de la capa de densidad
+COLORES_DENSIDAD = ["#ffffb2", "#fecc5c", "#fd8d3c", "#f03b20", "#bd0026"]
+
+
+def tamano_pixel_extension(bounds, ancho_px=ANCHO_MAPA_PX):
+    """Tamaño aproximado de un píxel (grados) cuando la extensión `bounds` ocupa el ancho del mapa."""
+    return max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / ancho_px
+
+
+def tamano_pixel_zoom(zoom):
+    """Tamaño de un píxel (grados) con el nivel de zoom de Leaflet."""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def nivel_densidad(tam_pixel):
+    """Nivel de la rejilla con la celda más fina que mide al menos PIXELES_MIN_CELDA píxeles."""
+    for nivel in range(len(TAMANOS_CELDA_DENSIDAD) - 1, -1, -1):
+        if TAMANOS_CELDA_DENSIDAD[nivel] >= PIXELES_MIN_CELDA * tam_pixel:
+            return nivel
+    return 0
+
+
+class RejillaDensidad:
+    """
+    Rejilla cuadrada jerárquica sobre las ocupaciones, calculada una vez por versión de los datos.
+    Se guarda sólo la celda del nivel más fino de cada punto (columna y fila, int32); la celda
+    de un nivel más grueso se obtiene desplazando bits, porque cada nivel duplica el lado.
+    Agregar cualquier subconjunto de puntos es entonces un `np.unique` sobre enteros.
+    """
+
+    def __init__(self, geometrias):
+        geometrias = np.asarray(geometrias)
+        x, y = shapely.get_x(geometrias), shapely.get_y(geometrias)
+        tam_grueso, tam_fino = TAMANOS_CELDA_DENSIDAD[0], TAMANOS_CELDA_DENSIDAD[-1]
+        # Origen alineado con la rejilla más gruesa para que las celdas de todos los niveles encajen
+        self.origen = (np.floor(np.nanmin(x) / tam_grueso) * tam_grueso, np.floor(np.nanmin(y) / tam_grueso) * tam_grueso)
+        self.columnas = np.floor((x - self.origen[0]) / tam_fino).astype(np.int32)
+        self.filas = np.floor((y - self.origen[1]) / tam_fino).astype(np.int32)
+
+    def celdas(self, posiciones, nivel):
+        """
+        GeoDataFrame (EPSG:4326) con las celdas del `nivel` que contienen alguno de los puntos en
+        `posiciones` y la cantidad de ocupaciones de cada una (columna 'Ocupaciones').
+        """
+        posiciones = np.unique(posiciones)
+        desplazamiento = len(TAMANOS_CELDA_DENSIDAD) - 1 - nivel
+        columnas = (self.columnas[posiciones] >> desplazamiento).astype(np.int64)
+        filas = (self.filas[posiciones] >> desplazamiento).astype(np.int64)
+        codigos, cantidades = np.unique((columnas << 32) | filas, return_counts=True)
+
+        tam = TAMANOS_CELDA_DENSIDAD[nivel]
+        minx = self.origen[0] + (codigos >> 32) * tam
+        miny = self.origen[1] + (codigos & 0xFFFFFFFF) * tam
+        return gpd.GeoDataFrame(
+            {"Ocupaciones": cantidades},
+            geometry=redondear_coordenadas(shapely.box(minx, miny, minx + tam, miny + tam)),
+            crs="EPSG:4326",
+        )
+
+
+def geojson_densidad(gdf_celdas):
+    """
+    GeoJSON (texto) de las celdas de densidad con la clase de color de cada una (cuantiles de
+    las cantidades mostradas), para `capa_densidad`.
+    """
+    cortes = np.unique(np.quantile(gdf_celdas["Ocupaciones"], np.linspace(0, 1, len(COLORES_DENSIDAD) + 1)[1:-1]))
+    clases = np.searchsorted(cortes, gdf_celdas["Ocupaciones"].to_numpy(), side="left")
+    return gdf_celdas.assign(clase=clases).to_json()
+
+
+def capa_densidad(geojson_celdas, nombre):
+    """Coropleta de las celdas de `geojson_densidad`; el tooltip indica la cantidad de ocupaciones."""
+    return folium.GeoJson(
+        geojson_celdas,
+        name=nombre,
+        style_function=lambda feature: {
+            "fillColor": COLORES_DENSIDAD[feature["properties"]["clase"]],
+            "color": COLORES_DENSIDAD[feature["properties"]["clase"]],
+            "weight": 0.5,
+            "fillOpacity": 0.65,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["Ocupaciones"], aliases=["Ocupaciones en la celda:"], localize=True),
+    )
+
+
+class CacheLRU:
+    """
+    Caché LRU acotada por tamaño (bytes) para las capas serializadas y descargas ya generadas de cada
+    combinación de filtros. Es compartida entre sesiones, así que todas las operaciones
+    se protegen con un candado. Al superar `max_bytes` se descartan las entradas usadas
+    hace más tiempo (siempre se conserva la más reciente).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()  # clave -> (valor, tamaño en bytes)
+        self._total_bytes = 0
+        self._bloqueo = threading.Lock()
+
+    def obtener(self, clave):
+        """Devuelve el valor guardado para `clave` (marcándolo como reciente) o None."""
+        with self._bloqueo:
+            if clave not in self._entradas:
+                return None
+            self._entradas.move_to_end(clave)
+            return self._entradas[clave][0]
+
+    def guardar(self, clave, valor, tamano):
+        """Guarda (o reemplaza) `valor` con su tamaño aproximado y aplica el límite."""
+        with self._bloqueo:
+            if clave in self._entradas:
+                self._total_bytes -= self._entradas[clave][1]
+            self._entradas[clave] = (valor, tamano)
+            self._entradas.move_to_end(clave)
+            self._total_bytes += tamano
+            while self._total_bytes > self.max_bytes and len(self._entradas) > 1:
+                _, (_, tamano_descartado) = self._entradas.popitem(last=False)
+                self._total_bytes -= tamano_descartado
+
+    def __len__(self):
+        return len(self._entradas)
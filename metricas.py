@@ -0,0 +1,105 @@
+# --- MEDICIÓN DE TIEMPOS POR ETAPA ---
+# --- Cronometra las etapas costosas (descarga, lectura, reproyección, asignación, mapa, exportaciones),
+# --- guarda un resumen en memoria para el panel de rendimiento y emite una línea JSON por medición ---
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Logger de métricas: una línea JSON por medición. Si BOT_ARCHIVO_METRICAS está definido,
+# además se escriben en ese archivo (JSON Lines) para recolectarlas desde fuera.
+logger = logging.getLogger("bot.metricas")
+
+ARCHIVO_METRICAS = os.environ.get("BOT_ARCHIVO_METRICAS")
+if ARCHIVO_METRICAS and not logger.handlers:
+    _manejador = logging.FileHandler(ARCHIVO_METRICAS, encoding="utf-8")
+    _manejador.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_manejador)
+    logger.setLevel(logging.INFO)
+
+# Ejecución en curso (p. ej. una corrida del script de Streamlit): se anota en cada medición hecha
+# en ese contexto, para distinguirlas de las de otras sesiones o del hilo de refresco
+_ejecucion = contextvars.ContextVar("ejecucion", default=None)
+
+# Número de mediciones recientes que se conservan en memoria
+MAX_MEDICIONES_RECIENTES = 500
+
+
+class RegistroTiempos:
+    """Mediciones recientes y acumulados por etapa; seguro para usar desde varios hilos."""
+
+    def __init__(self, max_recientes=MAX_MEDICIONES_RECIENTES):
+        self.recientes = deque(maxlen=max_recientes)
+        self.por_etapa = {}
+        self._bloqueo = threading.Lock()
+
+    def agregar(self, medicion):
+        with self._bloqueo:
+            self.recientes.append(medicion)
+            acumulado = self.por_etapa.setdefault(
+                medicion["etapa"], {"llamadas": 0, "total_ms": 0.0, "max_ms": 0.0, "ultima": None}
+            )
+            acumulado["llamadas"] += 1
+            acumulado["total_ms"] += medicion["ms"]
+            acumulado["max_ms"] = max(acumulado["max_ms"], medicion["ms"])
+            acumulado["ultima"] = medicion
+
+    def desde(self, marca_tiempo, ejecucion=None):
+        """Mediciones recientes terminadas después de `marca_tiempo` (time.time()), sólo de `ejecucion` si se indica."""
+        with self._bloqueo:
+            return [m for m in self.recientes
+                    if m["marca_tiempo"] >= marca_tiempo and (ejecucion is None or m.get("ejecucion") == ejecucion)]
+
+    def resumen(self):
+        """Una fila por etapa: llamadas, última/media/máxima duración (ms) y detalles de la última."""
+        with self._bloqueo:
+            filas = []
+            for etapa, a in self.por_etapa.items():
+                detalles = {k: v for k, v in a["ultima"].items() if k not in ("etapa", "ms", "marca_tiempo", "ejecucion")}
+                filas.append({
+                    "etapa": etapa,
+                    "llamadas": a["llamadas"],
+                    "ultima_ms": round(a["ultima"]["ms"], 1),
+                    "media_ms": round(a["total_ms"] / a["llamadas"], 1),
+                    "max_ms": round(a["max_ms"], 1),
+                    "detalles": json.dumps(detalles, ensure_ascii=False, default=str),
+                })
+            return filas
+
+
+# Registro compartido por todo el proceso
+registro = RegistroTiempos()
+
+
+def iniciar_ejecucion():
+    """Asigna un identificador nuevo a las mediciones siguientes de este contexto y lo devuelve."""
+    ejecucion = uuid.uuid4().hex[:12]
+    _ejecucion.set(ejecucion)
+    return ejecucion
+
+
+@contextmanager
+def medir(etapa, **detalles):
+    """
+    Cronometra el bloque y registra la medición con `detalles` (p. ej. capa, features, bytes).
+    El diccionario que se entrega permite añadir detalles conocidos al final del bloque:
+
+        with metricas.medir("lectura_shapefile", capa="puntos") as m:
+            gdf = ...
+            m["features"] = len(gdf)
+    """
+    inicio = time.perf_counter()
+    try:
+        yield detalles
+    finally:
+        medicion = {"etapa": etapa, "ms": (time.perf_counter() - inicio) * 1000, "marca_tiempo": time.time(), **detalles}
+        if _ejecucion.get() is not None:
+            medicion["ejecucion"] = _ejecucion.get()
+        registro.agregar(medicion)
+        logger.info(json.dumps(medicion, ensure_ascii=False, default=str))